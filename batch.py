@@ -0,0 +1,204 @@
+'''batch runs simulation jobs without user interaction
+A job file is a JSON list of jobs (or one job per line, JSON lines). A job is
+a dict with the data set, the mode and its parameters, e.g.
+  {"dataset": "geodata4.pickle", "mode": "angle", "start": 1e6, "end": 6e6,
+   "steps": 20, "iterations": 4}
+If dataset is a list, the job is run for each data set. Modes and their
+parameters (defaults as in simulation_magnetfeld.main):
+  point      lg, bg, h, i, cr, rtol       field at one point, with the loop resolution
+                                          and its error estimate (see bfieldAdaptiveBatch)
+  list       -                            measured data of the data set
+  angle      start, end, steps, iterations, method ('grid' or 'brent'), levels
+  magnitude  start, end, steps, iterations, method ('grid', 'brent' or 'linear'), cr, levels
+  joint      cr, i                        joint fit of radius and current
+  epochs     first, last, step, window, start, end, narrow
+                                          radius and current per epoch (see optimizeEpochs)
+  map        file, res, hs, i, cr         field map (see fieldMap); the file must differ
+                                          between jobs (default feldkarte_<k>.npy for job k)
+levels is a list of subsample levels for the first grid iterations (coarse
+to fine, see optimzeAngleLoop). Every job may also set model ('segments' or
+'exact') and instrument (true: the counters and timers of the run, see
+instrument, are added to the result).
+
+The jobs are run concurrently in a process pool and the results are written
+as JSON (one entry per job, in the order of the job file) and optionally as
+CSV with the scalar results.
+
+Usage:
+python batch.py jobs.json -o results.json --csv results.csv -j 8
+'''
+
+import argparse
+import csv
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+import simulation_magnetfeld as sm
+
+modes = ['point', 'list', 'angle', 'magnitude', 'joint', 'epochs', 'map']
+
+def read_jobs(fn):
+    '''Read a job file (JSON list or JSON lines) and expand jobs with a list
+    of data sets into one job per data set. Map jobs without a file get
+    feldkarte_<k>.npy, k being the index of the expanded job.'''
+    with open(fn) as f:
+        text = f.read()
+    try:
+        jobs = json.loads(text)
+        if isinstance(jobs, dict):
+            jobs = [jobs]
+    except ValueError:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    res = []
+    for job in jobs:
+        datasets = job.get('dataset', sm.pickle)
+        for ds in (datasets if isinstance(datasets, list) else [datasets]):
+            res.append(dict(job, dataset=ds))
+    # Map jobs run concurrently, so each one writes its own file
+    for k, job in enumerate(res):
+        if job.get('mode') == 'map' and 'file' not in job:
+            job['file'] = 'feldkarte_%03d.npy' % k
+    return res
+
+def run_job(job):
+    '''Run one job in this process. A dict with the job, its result (or the
+    error message) and the wall time in s is returned.'''
+    t = time.perf_counter()
+    try:
+        if job.get('instrument'):
+            with instrument.session() as report:
+                result = __run__(job)
+            return {'job': job, 'result': result, 'instrument': report,
+                    'seconds': time.perf_counter() - t}
+        result = __run__(job)
+        return {'job': job, 'result': result, 'seconds': time.perf_counter() - t}
+    except Exception as e:
+        return {'job': job, 'error': '%s: %s' % (type(e).__name__, e),
+                'traceback': traceback.format_exc(), 'seconds': time.perf_counter() - t}
+
+def __run__(job):
+    mode = job.get('mode')
+    if mode not in modes:
+        raise ValueError('unknown mode %r, expected one of %s' % (mode, modes))
+    # Jobs are already run in parallel, candidates are evaluated serially
+    sm.pickle = job['dataset']
+    sm.fieldmodel = job.get('model', 'segments')
+    sm.workers = 1
+
+    if mode == 'point':
+        lg, bg, h = job.get('lg', 0.0), job.get('bg', 0.0), job.get('h', 0.0)
+        b, n, est = sm.bfield(lg, bg, h, job.get('i', 1e9), job.get('cr', 5e6), rtol=job.get('rtol'),
+                              full_output=True)
+        ang = sm.angle(b, lg, bg, h)
+        return {'B': b.tolist(), 'magnitude': float(sm.norm(b)), 'angle': float(90 - ang),
+                'segments': int(n), 'error_estimate': None if est != est else float(est)}
+
+    if mode == 'list':
+        lgs, bgs, alts, mags, bs = sm.loadData(job['dataset'])
+        angs = sm.angleBatch(bs, lgs, bgs, alts)
+        return [{'lg': float(lgs[k]), 'bg': float(bgs[k]), 'h': float(alts[k]),
+                 'magnitude': float(mags[k]), 'angle': float(angs[k]),
+                 'B': [float(x) for x in bs[k]]} for k in range(len(lgs))]
+
+    if mode == 'angle':
+        start, end = job.get('start', 1e6), job.get('end', 6e6)
+        if job.get('method', 'grid') == 'brent':
+            cr, err, evals = sm.optimzeAngleBrent(start, end, job.get('tol', 1e-6),
+                                                  job.get('maxeval', 100))
+            return {'cr': float(cr), 'error': float(err), 'evaluations': evals}
+        cr, err = sm.optimzeAngleLoop(start, end, job.get('steps', 10), job.get('iterations', 3),
+                                      levels=job.get('levels'))
+        return {'cr': float(cr), 'error': float(err)}
+
+    if mode == 'magnitude':
+        start, end = job.get('start', 1e8), job.get('end', 1e10)
+        method = job.get('method', 'grid')
+        if method == 'linear':
+            i, err = sm.optimizeMagnitudeLinear(job.get('cr', 5e6))
+            return {'i': float(i), 'error': float(err)}
+        if method == 'brent':
+            i, err, evals = sm.optimizeMagnitudeBrent(start, end, job.get('tol', 1e-6),
+                                                      job.get('maxeval', 100))
+            return {'i': float(i), 'error': float(err), 'evaluations': evals}
+        i, err = sm.optimizeMagnitudeLoop(start, end, job.get('steps', 10), job.get('iterations', 3),
+                                          levels=job.get('levels'))
+        return {'i': float(i), 'error': float(err)}
+
+    if mode == 'joint':
+        cr, i, err, history, reason = sm.optimizeJoint(job.get('cr', 5e6), job.get('i'))
+        return {'cr': float(cr), 'i': float(i), 'error': float(err), 'iterations': len(history),
+                'reason': reason}
+
+    if mode == 'epochs':
+        step = job.get('step', 1.0)
+        epochs = sm.arange(job.get('first', 1990.0), job.get('last', 2016.0) + step / 2, step)
+        results = sm.optimizeEpochs(job['dataset'], epochs, job.get('window', 1.0),
+                                    job.get('start', 1e6), job.get('end', 6e6), job.get('narrow', 0.1))
+        return [{'epoch': float(epoch), 'n': n, 'cr': float(cr), 'i': float(i),
+                 'angle_error': float(angle_err), 'magnitude_error': float(mag_err),
+                 'evaluations': evals, 'at_bound': at_bound}
+                for epoch, n, cr, i, angle_err, mag_err, evals, at_bound in results]
+
+    if mode == 'map':
+        res = job.get('res', 1.0)
+        lgs = sm.arange(-180, 180, res)
+        bgs = sm.arange(-90, 90 + res / 2, res)
+        fn = job.get('file')
+        if not fn:
+            raise ValueError('map job without file (jobs run concurrently and must not share one)')
+        out = sm.fieldMap(fn, lgs, bgs, job.get('hs', [0.0]), job.get('i', 1e9), job.get('cr', 5e6))
+        return {'file': fn, 'shape': list(out.shape)}
+
+def run(jobs, n_workers=None):
+    '''Run all jobs with n_workers processes (default: number of CPUs).
+    The results (see run_job) are returned in the order of jobs.'''
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+    with ProcessPoolExecutor(n_workers) as pool:
+        return list(pool.map(run_job, jobs))
+
+def write_csv(results, fn):
+    '''Write one row per job with the job parameters, the scalar results and
+    the error message of failed jobs (column failure).'''
+    rows = []
+    for res in results:
+        row = {'job.' + k: v for k, v in res['job'].items() if not isinstance(v, (list, dict))}
+        if isinstance(res.get('result'), dict):
+            row.update({k: v for k, v in res['result'].items() if not isinstance(v, (list, dict))})
+        row['failure'] = res.get('error', '')
+        row['seconds'] = res['seconds']
+        rows.append(row)
+    fields = []
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    with open(fn, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run simulation jobs from a job file.')
+    parser.add_argument('jobs', help='job file (JSON list or JSON lines)')
+    parser.add_argument('-o', '--output', default='results.json', help='JSON result file')
+    parser.add_argument('--csv', help='CSV file with the scalar results')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    results = run(read_jobs(args.jobs), args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.csv:
+        write_csv(results, args.csv)
+
+    failed = sum(1 for res in results if 'error' in res)
+    print('%d jobs, %d failed, results in %s' % (len(results), failed, args.output))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
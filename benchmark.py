@@ -0,0 +1,231 @@
+'''benchmark measures the performance of geo and simulation_magnetfeld
+The suite covers field evaluation (bfieldBatch for a sweep of the number of
+stations N and the loop resolution n), ingestion of survey files
+(geo.db2 and geo.stream on synthetic files of increasing size), the
+preparation of the bundled data sets (geo.load and processData) and fitting
+(error of a sweep of candidates and a complete optimizer run).
+
+For every benchmark the best wall time of repeat runs, the throughput
+(points/s, lines/s, records/s or candidates/s) and the peak memory allocated
+during one extra run (measured with tracemalloc, which numpy reports to) are
+recorded. The results can be written to a JSON file and compared against a
+stored baseline; a benchmark is a regression if its throughput drops or its
+peak memory grows by more than the threshold (a fraction).
+The result cache (resultcache) is disabled while benchmarking.
+
+Synthetic survey files in MAGNET format are written by synthetic_survey with
+a fixed seed, so a run is reproducible.
+
+Usage:
+python benchmark.py -o baseline.json              # record a baseline
+python benchmark.py --baseline baseline.json      # compare, exit code 1 on regression
+python benchmark.py --quick --filter bfield       # small sizes, bfield only
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+import numpy as np
+
+import geo
+import resultcache
+import simulation_magnetfeld as sm
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Sizes of the sweeps, (quick, full)
+sizes = {
+    'stations': ([100, 1000, 10000], [100, 1000, 10000, 100000]),
+    'resolution': ([25, 100], [25, 100, 400]),
+    'lines': ([1000, 10000], [1000, 10000, 100000, 1000000]),
+    'candidates': ([4, 16], [4, 16, 64]),
+}
+
+def survey_line(name, date, colat, elong, decl, incl, hor, nor, east, vert, tot, alt):
+    '''Line in MAGNET format (see the end of geo.py) with the given items.'''
+    return ('%-15.15s%9.3f%9.3f%8.3f%10.3f%8.3f%6.0f.%7.0f.%7.0f.%7.0f.%6.0f.%5d%2d%4d%8d%7s%4d%5s\n'
+            % (name, date, colat, elong, decl, incl, hor, nor, east, vert, tot, alt,
+               9, 1, 1, '2121121', 0, 'XX'))
+
+def synthetic_survey(fn, n, seed=0):
+    '''Write a survey file fn with n random, consistent stations (dates
+    1990 to 2020, uniform on the sphere, a field similar to a dipole).'''
+    rng = np.random.RandomState(seed)
+    colat = np.rad2deg(np.arccos(rng.uniform(-1, 1, n)))
+    elong = rng.uniform(0, 360, n)
+    date = rng.uniform(1990, 2020, n)
+    alt = rng.randint(0, 3000, n)
+    nor = np.round(30000 * np.sin(np.deg2rad(colat)) + rng.normal(0, 2000, n))
+    east = np.round(rng.normal(0, 2000, n))
+    vert = np.round(60000 * np.cos(np.deg2rad(colat)) + rng.normal(0, 2000, n))
+    hor = np.hypot(nor, east)
+    tot = np.sqrt(hor**2 + vert**2)
+    incl = np.rad2deg(np.arctan2(vert, hor))
+    decl = np.rad2deg(np.arctan2(east, nor))
+    with open(fn, 'w') as f:
+        for k in range(n):
+            f.write(survey_line('SYNTH_%09d' % k, date[k], colat[k], elong[k], decl[k], incl[k],
+                                round(hor[k]), nor[k], east[k], vert[k], round(tot[k]), alt[k]))
+
+def stations(n, seed=0):
+    '''Arrays of longitudes, latitudes [°] and altitudes [m] of n random stations.'''
+    rng = np.random.RandomState(seed)
+    return (rng.uniform(-180, 180, n), np.rad2deg(np.arcsin(rng.uniform(-1, 1, n))),
+            rng.uniform(0, 3000, n))
+
+def cases(quick=False, tmpdir=None):
+    '''Generator over the benchmarks as tuples (name, func, work, unit): func
+    is called without arguments and does work units of work.'''
+    pick = 0 if quick else 1
+
+    # Field evaluation
+    for N in sizes['stations'][pick]:
+        lgs, bgs, hs = stations(N)
+        for n in sizes['resolution'][pick]:
+            yield ('bfield/segments/N=%d/n=%d' % (N, n),
+                   partial(sm.bfieldSegmentsBatch, lgs, bgs, hs, 1e9, 5e6, n), N, 'points/s')
+        yield ('bfield/exact/N=%d' % N,
+               partial(sm.bfieldExactBatch, lgs, bgs, hs, 1e9, 5e6), N, 'points/s')
+
+    # Ingestion of synthetic survey files
+    for n in sizes['lines'][pick]:
+        fn = os.path.join(tmpdir, 'survey_%d.html' % n)
+        synthetic_survey(fn, n)
+        yield ('db2/bulk/lines=%d' % n, partial(geo.db2, 1900, 0, fn), n, 'lines/s')
+        yield ('db2/mindist/lines=%d' % n, partial(geo.db2, 1900, 1e5, fn), n, 'lines/s')
+        if n <= 10000:
+            yield ('db2/lines/lines=%d' % n, partial(geo.db2, 1900, 0, fn, bulk=False), n, 'lines/s')
+        yield ('stream/lines=%d' % n, partial(lambda fn: sum(len(c['alt']) for c in geo.stream(1900, fn)), fn),
+               n, 'lines/s')
+        yield ('streamErrors/lines=%d' % n, partial(sm.streamErrors, fn, 1e9, 5e6, 1900), n, 'lines/s')
+
+    # Bundled data sets
+    for fn in sorted(glob.glob(os.path.join(here, 'geodata*.pickle'))):
+        name = os.path.basename(fn)
+        n = len(geo.load(fn))
+        yield ('processData/%s' % name, partial(lambda fn: sm.processData(geo.load(fn)), fn),
+               n, 'records/s')
+        for k in sizes['candidates'][pick]:
+            crs = list(np.linspace(1e6, 6e6, k))
+            yield ('candidates/%s/k=%d' % (name, k),
+                   partial(sm.mapCandidates, partial(sm.angleError, i=1e9, fn=fn), crs), k, 'candidates/s')
+
+    # Complete optimizer run on the largest bundled data set
+    fn = os.path.join(here, 'geodata0.pickle')
+    if os.path.exists(fn):
+        steps, iterations = 10, 3
+        def fit():
+            sm.pickle = fn
+            return sm.optimzeAngleLoop(1e6, 6e6, steps, iterations)
+        yield ('optimzeAngleLoop/geodata0.pickle', fit, steps * iterations, 'candidates/s')
+
+def measure(func, work, repeat=3):
+    '''Best wall time of repeat calls of func, the throughput (work per s)
+    and the peak memory of one more call.'''
+    func()  # warm up (caches, imports)
+    best = float('inf')
+    for k in range(repeat):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'throughput': work / best if best > 0 else float('inf'),
+            'peak_bytes': peak}
+
+def run(quick=False, repeat=3, pattern=None, verbose=True):
+    '''Run the benchmarks (those whose name matches the regular expression
+    pattern) and return the results as a dict (see module description).'''
+    enabled = resultcache.enabled
+    resultcache.enabled = False
+    tmpdir = tempfile.mkdtemp(prefix='benchmark')
+    results = {}
+    try:
+        for name, func, work, unit in cases(quick, tmpdir):
+            if pattern and not re.search(pattern, name):
+                continue
+            res = measure(func, work, repeat)
+            res.update(work=work, unit=unit)
+            results[name] = res
+            if verbose:
+                print('%-45s %12.4g %-13s %9.3f ms %8.1f MB'
+                      % (name, res['throughput'], unit, 1e3 * res['seconds'], res['peak_bytes'] / 1e6))
+    finally:
+        resultcache.enabled = enabled
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'machine': platform.machine(), 'processor': platform.processor(),
+                     'cpus': os.cpu_count(), 'workers': sm.workers, 'quick': quick,
+                     'kernel': 'numba' if sm.kernel == 'auto' and sm.compiledKernel() else 'numpy',
+                     'repeat': repeat, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+def compare(current, baseline, threshold=0.1, min_bytes=1 << 20):
+    '''Compare two runs (dicts as returned by run). A list of tuples
+    (name, baseline throughput, current throughput, ratio, regressions) for
+    the benchmarks in both runs is returned, where regressions is a list of
+    'throughput' and/or 'memory'. Memory differences below min_bytes are
+    ignored.'''
+    rows = []
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = cur['throughput'] / base['throughput']
+        regressions = []
+        if ratio < 1 - threshold:
+            regressions.append('throughput')
+        if (cur['peak_bytes'] > (1 + threshold) * base['peak_bytes']
+                and cur['peak_bytes'] - base['peak_bytes'] > min_bytes):
+            regressions.append('memory')
+        rows.append((name, base['throughput'], cur['throughput'], ratio, regressions))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark field evaluation, ingestion and fitting.')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed relative loss of throughput or gain of memory (default 0.1)')
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark')
+    parser.add_argument('--filter', help='run only benchmarks matching this regular expression')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='workers for the candidate evaluation (see simulation_magnetfeld.workers)')
+    args = parser.parse_args(argv)
+
+    sm.workers = args.workers
+    current = run(args.quick, args.repeat, args.filter)
+    sm.shutdownPools()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(current, baseline, args.threshold)
+    print()
+    print('%-45s %12s %12s %7s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name, base, cur, ratio, regressions in rows:
+        print('%-45s %12.4g %12.4g %7.3f %s' % (name, base, cur, ratio, ' '.join(regressions)))
+    failed = [row[0] for row in rows if row[4]]
+    print('%d benchmarks compared, %d regressions' % (len(rows), len(failed)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
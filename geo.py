@@ -10,6 +10,13 @@ A file (sdatextr.html by default) with data can be obtained from
 http://www.geomag.bgs.ac.uk/data_service/data/surveydata.shtml
 For conviniece, indices ialt, ilat, ilong, iB, igmlat, igmlong, isim, iitem are given.
 
+For large data sets a columnar format is available: dump_columns (or convert for
+existing pickle files) writes a directory with one .npy file per column, which
+load_columns maps into memory without building any Python objects per record.
+In memory, compact (or db2(..., compact_db=True)) stores records in a numpy
+structured array (class Records); its elements can be indexed like the lists,
+e.g. rec[iB], but take a fraction of the memory.
+
 Example:
 import geo
 db = geo.db2(2013)
@@ -32,9 +39,15 @@ This results in the following output:
 import numpy as np
 import numpy.linalg as la
 
+import instrument
+
 re = 6.3710e6  # Erdradius im m
 B0 = 21.295e-6 / np.cos(np.deg2rad(63.30))  # Source: Formelbuch S. 204 (Zürich 2006.5)
 ialt, ilat, ilong, iB, igmlat, igmlong, sim, iitem = 0, 1, 2, 3, 4, 5, 6, 7
+# Columns that separate items in data (MAGNET format, see end of file)
+itemcols = [0, 15, 24, 33, 41, 51, 59, 66, 74, 82, 90, 97, 102, 104, 108, 116, 123, 127, 132]
+# Numeric columns of the columnar format (see dump_columns), all float64
+columns = ['alt', 'lat', 'long', 'B', 'gmlat', 'gmlong', 'date']
 
 def cart2spher(xyz):
     '''Convert Cartesian (x,y,z) coordinates to spherical (r,theta,phi) coordinates.
@@ -55,15 +68,14 @@ def spher2cart(r, bg, lg):
                      r * np.cos(bg) * np.sin(lg),
                      r * np.sin(bg)])
 
-def __magnet__(db, line, year=2010, mindist=0):
+def __magnet__(db, line, year=2010, mindist=0, grid=None):
     '''Interpret a line from MAGNET format and convert the field to Cartesian coordinates.
     A list (see module description) with data newer than year is appended to db
     if the distance to all geometric points in db is greater than mindist.
-    For db a list is expected.'''
+    For db a list is expected, grid is its optional spatial index (see __insert__).'''
     rad = 180 / np.pi
     deg = np.pi / 180
-    # Columns that separate items in data
-    cols = [0, 15, 24, 33, 41, 51, 59, 66, 74, 82, 90, 97, 102, 104, 108, 116, 123, 127, 132]
+    cols = itemcols
     # Do a sanity check for each line as many data are invalid.
     # Ignore invalid lines
     try:  # try except handles conversion and other errors
@@ -106,45 +118,433 @@ def __magnet__(db, line, year=2010, mindist=0):
             or alti < -500):
             return
 
-        # Add data to db2 if far enough from all other points
-        if mindist > 0:
-            for i in range(len(db)):
-                rec = db[i]
-                dist = la.norm(spher2cart(rec[ialt] + re, rec[ilat], rec[ilong])
-                               - spher2cart(alti + re, lat, long))
-                if dist < mindist:
-                    # If station is very close and data are newer, replace record
-                    if (dist < mindist / 100) and (dat > float(rec[iitem][1])):
-                        db[i] = [alti, lat, long, B, None, None, [], item]
-                    return
-        db.append([alti, lat, long, B, None, None, [], item])
+        __insert__(db, [alti, lat, long, B, None, None, [], item], mindist, grid)
 
     except ValueError:
         return  # If any conversion error occurs, the line is ignored
 
+def __cell__(xyz, mindist):
+    '''Cell of the Cartesian point xyz in a grid with cell size mindist.'''
+    return (int(np.floor(xyz[0] / mindist)),
+            int(np.floor(xyz[1] / mindist)),
+            int(np.floor(xyz[2] / mindist)))
+
+def __insert__(db, new, mindist=0, grid=None):
+    '''Append the record new to db if the distance to all geometric points in db
+    is greater than mindist. If a record closer than mindist/100 exists and new
+    has a newer date, it is replaced by new instead.
+    grid is an optional spatial index of db (a dict, empty for an empty db)
+    mapping cells of size mindist in Cartesian coordinates to indices in db.
+    With it only records in the 27 cells around new are compared instead of
+    all records; the result is the same.'''
+    # Add data to db2 if far enough from all other points
+    if mindist > 0:
+        dat = float(new[iitem][1])
+        xyz = spher2cart(new[ialt] + re, new[ilat], new[ilong])
+        if grid is None:
+            candidates = range(len(db))
+        else:
+            cx, cy, cz = __cell__(xyz, mindist)
+            candidates = sorted(i for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                                for i in grid.get((cx + dx, cy + dy, cz + dz), ()))
+        for i in candidates:
+            rec = db[i]
+            old = spher2cart(rec[ialt] + re, rec[ilat], rec[ilong])
+            dist = la.norm(old - xyz)
+            if dist < mindist:
+                # If station is very close and data are newer, replace record
+                if (dist < mindist / 100) and (dat > float(rec[iitem][1])):
+                    db[i] = new
+                    if grid is not None:
+                        grid[__cell__(old, mindist)].remove(i)
+                        grid.setdefault(__cell__(xyz, mindist), []).append(i)
+                return
+        if grid is not None:
+            grid.setdefault(__cell__(xyz, mindist), []).append(len(db))
+    db.append(new)
+
+def __column__(lines, k):
+    '''Convert item k of all lines (array of fixed-width strings) to float.
+    A tuple (values, ok) is returned, where ok is False for items that cannot
+    be converted (the values are nan there).'''
+    # Characters of item k as one string per line
+    chars = lines.view('U1').reshape(len(lines), -1)[:, itemcols[k]:itemcols[k + 1]]
+    strs = np.ascontiguousarray(chars).view('U%d' % (itemcols[k + 1] - itemcols[k]))[:, 0]
+    try:
+        return strs.astype(np.float64), np.ones(len(strs), dtype=bool)
+    except ValueError:
+        # At least one invalid item: convert one by one as float() would do
+        values = np.full(len(strs), np.nan)
+        ok = np.zeros(len(strs), dtype=bool)
+        for i, item in enumerate(strs):
+            try:
+                values[i] = float(item)
+                ok[i] = True
+            except ValueError:
+                pass
+        return values, ok
+
+def __parse_bulk__(lines, year=2010):
+    '''Interpret a list of lines in MAGNET format at once with numpy.
+    A dict with the columns alt, lat, long, B, date (see dump_columns) and
+    lines of the valid records is returned.'''
+    deg = np.pi / 180
+    # Only lines of plausible length are interpreted (see __magnet__)
+    lines = [line for line in lines if 129 <= len(line) <= 134]
+    if len(lines) == 0:
+        return {'alt': np.empty(0), 'lat': np.empty(0), 'long': np.empty(0),
+                'B': np.empty((0, 3)), 'date': np.empty(0), 'lines': []}
+    # Fixed-width array, shorter lines are padded
+    fixed = np.array(lines, dtype='U134')
+
+    values = {}
+    valid = np.ones(len(fixed), dtype=bool)
+    for k in [1, 2, 3, 5, 6, 7, 8, 9, 10, 11]:
+        values[k], ok = __column__(fixed, k)
+        valid &= ok
+
+    dat = values[1]
+    lat = (90 - values[2]) * deg
+    long = values[3] * deg
+    incl = values[5] * deg
+    hor = values[6] * 1e-9
+    nor = values[7] * 1e-9
+    east = values[8] * 1e-9
+    vert = values[9] * 1e-9
+    tot = values[10] * 1e-9
+    alti = values[11]
+
+    # Convert magn. field to Cartesian coordinates, all records at once
+    # Unit vector in vertical, east, and north direction
+    ev = spher2cart(1, lat, long).T
+    ee = np.stack([-np.sin(long), np.cos(long), np.zeros(len(long))], axis=1)
+    en = np.cross(ev, ee)
+    B = vert[:, None] * ev + east[:, None] * ee + nor[:, None] * en
+
+    # Check data consistency (the same masks as __magnet__, where records
+    # with non-finite deviations are rejected by the conversion to int)
+    maxerror = 5  # used as multiple of resolution
+    dhor = np.abs(hor - np.sqrt(nor**2 + east**2))
+    dtot = np.abs(tot - la.norm(B, axis=1))
+    dincl = np.abs(incl - np.arctan2(vert, hor))
+    valid &= np.isfinite(dhor) & np.isfinite(dtot) & np.isfinite(dincl)
+    with np.errstate(invalid='ignore'):
+        valid &= ~(dat < year)
+        valid &= ~((dhor > maxerror * 1e-9) | (dtot > maxerror * 1e-9)
+                   | (dincl > maxerror * 0.001) | (alti < -500))
+
+    idx = np.flatnonzero(valid)
+    return {'alt': alti[idx], 'lat': lat[idx], 'long': long[idx], 'B': B[idx],
+            'date': dat[idx], 'lines': [lines[i] for i in idx]}
+
+def __split_bulk__(lines):
+    '''Split a list of MAGNET lines into items (as split_items) with numpy,
+    one column of items at a time. A list of item lists is returned.'''
+    if len(lines) == 0:
+        return []
+    fixed = np.array(lines, dtype='U134')
+    chars = fixed.view('U1').reshape(len(fixed), -1)
+    items = []
+    for k in range(len(itemcols) - 1):
+        width = itemcols[k + 1] - itemcols[k]
+        col = np.ascontiguousarray(chars[:, itemcols[k]:itemcols[k + 1]]).view('U%d' % width)[:, 0]
+        items.append(col.tolist())
+    return [list(item) for item in zip(*items)]
+
+def __magnet_bulk__(db, lines, year=2010, mindist=0, grid=None):
+    '''Interpret a list of lines in MAGNET format at once. The result is the
+    same as calling __magnet__ for each line, but the conversion, the date
+    filter and the consistency checks are done with numpy on whole columns
+    (see __parse_bulk__). Without mindist the records are appended directly.'''
+    cols = __parse_bulk__(lines, year)
+    if mindist <= 0:
+        db.extend([[alt, lat, long, B, None, None, [], item]
+                   for alt, lat, long, B, item in zip(cols['alt'].tolist(), cols['lat'].tolist(),
+                                                      cols['long'].tolist(), cols['B'].copy(),
+                                                      __split_bulk__(cols['lines']))])
+        return
+    for i, line in enumerate(cols['lines']):
+        item = [line[itemcols[k]:itemcols[k + 1]] for k in range(len(itemcols) - 1)]
+        __insert__(db, [float(cols['alt'][i]), float(cols['lat'][i]), float(cols['long'][i]),
+                        cols['B'][i].copy(), None, None, [], item], mindist, grid)
+
 itemdesc = 'Station_name  Date       Colat  E-long    Declin   Inclin  Horiz   North  East    Vertic Total  Alt D so  SerNr   el_cod GMT Count'.split()
 
 
-def db2(year=2010, mindist=0, file='sdatextr.html'):
+def db2(year=2010, mindist=0, file='sdatextr.html', bulk=True, chunk=1 << 22, compact_db=False):
     '''db2(year) is a data set that contains records that is newer
      than year (2010 is the default). To obtain a more equal
      distribution of points across the globe, a minimum distance
-     between points can be defined. Data are taken from file.'''
+     between points can be defined. Data are taken from file.
+     With bulk (default) the file is read in chunks of about chunk
+     characters which are parsed with numpy (__magnet_bulk__),
+     otherwise line by line (__magnet__). The mindist check uses
+     a spatial index of the records (see __insert__). With compact_db
+     the records are returned as Records (see compact); with bulk and
+     without mindist they are built directly from the parsed columns.'''
+
+    if bulk and compact_db and mindist <= 0:
+        parts = [__compact_parsed__(cols) for cols in stream(year, file, chunk)]
+        db = __join_compact__(parts)
+        if len(db) == 0:
+            print('Warning geo.db2: database is empty')
+        return db
 
     db = []
+    grid = {}
     with open(file) as f:
-        for rec in f:
-            __magnet__(db, rec, year, mindist)
+        if bulk:
+            while True:
+                lines = f.readlines(chunk)
+                if not lines:
+                    break
+                __magnet_bulk__(db, lines, year, mindist, grid)
+        else:
+            for rec in f:
+                __magnet__(db, rec, year, mindist, grid)
     if len(db) == 0:
         print('Warning geo.db2: database is empty')
+    if compact_db:
+        return compact(db)
     return db
 
+def stream(year=2010, file='sdatextr.html', chunk=1 << 22):
+    '''Generator over the valid records of file newer than year, without
+    building the database. The file is read in chunks of about chunk
+    characters; for each chunk a dict with the columns alt, lat, long, B,
+    date and the raw lines is yielded (see __parse_bulk__). No mindist
+    thinning is done, as it needs all records at once.'''
+    with open(file) as f:
+        while True:
+            lines = f.readlines(chunk)
+            if not lines:
+                break
+            cols = __parse_bulk__(lines, year)
+            if len(cols['alt']) > 0:
+                yield cols
+
+@instrument.timed('load')
 def load(fn):
     '''Load gedate from fn (pickle-file)'''
     import pickle
     with open(fn, 'rb') as f:
         return pickle.load(f)
 
+def recdtype(width=itemcols[-1]):
+    '''Structured dtype of one record in Records: the numeric columns (see
+    columns) and line, the MAGNET line as UTF-8 bytes of at most width bytes.'''
+    return np.dtype([('alt', 'f8'), ('lat', 'f8'), ('long', 'f8'), ('B', 'f8', (3,)),
+                     ('gmlat', 'f8'), ('gmlong', 'f8'), ('date', 'f8'), ('line', 'S%d' % width)])
+
+# Field of the structured array for each record index (sim has no field)
+recfields = {ialt: 'alt', ilat: 'lat', ilong: 'long', iB: 'B', igmlat: 'gmlat', igmlong: 'gmlong'}
+
+class Record:
+    '''View of one record in Records, indexed like the record lists, e.g.
+    rec[iB]. gmlat and gmlong are None if not set, sim is an empty list and
+    item is split from the stored line on access.'''
+    __slots__ = ('data', 'k')
+
+    def __init__(self, data, k):
+        self.data = data
+        self.k = k
+
+    def __len__(self):
+        return iitem + 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx == iitem:
+            return split_items(self.data['line'][self.k])
+        if idx == sim:
+            return []
+        if idx not in recfields:
+            raise IndexError('record index out of range')
+        value = self.data[recfields[idx]][self.k]
+        if idx in (igmlat, igmlong):
+            return None if np.isnan(value) else float(value)
+        return value if idx == iB else float(value)
+
+    def __setitem__(self, idx, value):
+        if idx < 0:
+            idx += len(self)
+        if idx not in recfields:
+            raise IndexError('record index not writable')
+        self.data[recfields[idx]][self.k] = np.nan if value is None else value
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        return repr(list(self))
+
+class Records:
+    '''Compact list of records, backed by a numpy structured array data (see
+    recdtype). Indexing returns a Record (or Records for slices); columns()
+    gives the arrays of columns as views without copying.'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return Records(self.data[k])
+        if k < 0:
+            k += len(self.data)
+        if not 0 <= k < len(self.data):
+            raise IndexError('record index out of range')
+        return Record(self.data, k)
+
+    def __iter__(self):
+        return (Record(self.data, k) for k in range(len(self.data)))
+
+    def columns(self):
+        '''Dict with the numeric columns (see columns) as views of data.'''
+        return {name: self.data[name] for name in columns}
+
+    def tolist(self):
+        '''List of records (lists) as returned by db2.'''
+        return [list(rec) for rec in self]
+
+def __compact_parsed__(cols):
+    '''Records (see compact) of the columns of one chunk as returned by
+    __parse_bulk__, without building the record lists.'''
+    lines = [line[:itemcols[-1]].encode('utf-8') for line in cols['lines']]
+    data = np.zeros(len(lines), dtype=recdtype(max([len(line) for line in lines] + [1])))
+    for name in ['alt', 'lat', 'long', 'B', 'date']:
+        data[name] = cols[name]
+    data['gmlat'] = np.nan
+    data['gmlong'] = np.nan
+    data['line'] = lines
+    return data
+
+def __join_compact__(parts):
+    '''Records with the structured arrays parts (see __compact_parsed__)
+    one after the other, the line field as wide as the widest part.'''
+    width = max([part.dtype['line'].itemsize for part in parts] + [1])
+    data = np.zeros(sum(len(part) for part in parts), dtype=recdtype(width))
+    k = 0
+    for part in parts:
+        for name in part.dtype.names:
+            data[name][k:k + len(part)] = part[name]
+        k += len(part)
+    return Records(data)
+
+def compact(db):
+    '''Convert a list of records (see module description) to Records.'''
+    lines = [''.join(rec[iitem]).encode('utf-8') for rec in db]
+    data = np.zeros(len(db), dtype=recdtype(max([len(line) for line in lines] + [1])))
+    nan = float('nan')
+    data['alt'] = [rec[ialt] for rec in db]
+    data['lat'] = [rec[ilat] for rec in db]
+    data['long'] = [rec[ilong] for rec in db]
+    data['B'] = np.reshape([rec[iB] for rec in db], (len(db), 3))
+    data['gmlat'] = [nan if rec[igmlat] is None else rec[igmlat] for rec in db]
+    data['gmlong'] = [nan if rec[igmlong] is None else rec[igmlong] for rec in db]
+    data['date'] = [float(rec[iitem][1]) for rec in db]
+    data['line'] = lines
+    return Records(data)
+
+def dump_columns(db, dn):
+    '''Write the records of db to the directory dn in columnar format.
+    Each entry of columns is stored as float64 .npy file (alt, lat, long in m and
+    rad, B in T as array of shape (N, 3), gmlat and gmlong in rad or nan if not
+    set, date in decimal years). items.npy is the string table with the MAGNET
+    line of each record (UTF-8 bytes), joined from item (split again by
+    split_items).'''
+    import os
+    os.makedirs(dn, exist_ok=True)
+    nan = float('nan')
+    cols = {'alt': [rec[ialt] for rec in db],
+            'lat': [rec[ilat] for rec in db],
+            'long': [rec[ilong] for rec in db],
+            'B': np.reshape([rec[iB] for rec in db], (len(db), 3)),
+            'gmlat': [nan if rec[igmlat] is None else rec[igmlat] for rec in db],
+            'gmlong': [nan if rec[igmlong] is None else rec[igmlong] for rec in db],
+            'date': [float(rec[iitem][1]) for rec in db]}
+    for name in columns:
+        np.save(os.path.join(dn, name + '.npy'), np.asarray(cols[name], dtype=np.float64))
+    items = [''.join(rec[iitem]).encode('utf-8') for rec in db]
+    width = max([len(item) for item in items] + [1])
+    np.save(os.path.join(dn, 'items.npy'), np.array(items, dtype='S%d' % width))
+
+def convert(src, dn):
+    '''Convert a data set to columnar format in directory dn. src is either
+    the name of a pickle file (see load) or a list of records as returned by db2.'''
+    if isinstance(src, str):
+        src = load(src)
+    dump_columns(src, dn)
+
+@instrument.timed('load')
+def load_columns(dn, mmap_mode='r'):
+    '''Open a columnar data set written by dump_columns. A dict with the arrays
+    of columns and 'items' is returned. By default the files are memory-mapped
+    read-only, so no data are copied until they are used.'''
+    import os
+    res = {}
+    for name in columns + ['items']:
+        res[name] = np.load(os.path.join(dn, name + '.npy'), mmap_mode=mmap_mode)
+    return res
+
+def split_items(line):
+    '''Split a MAGNET line (e.g. from the items table of load_columns) into the
+    list of items used in records.'''
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return [line[itemcols[i]:itemcols[i + 1]] for i in range(len(itemcols) - 1)]
+
+def from_columns(cols):
+    '''Build the list of records (see module description) from a columnar data
+    set as returned by load_columns.'''
+    db = []
+    for k in range(len(cols['alt'])):
+        gmlat, gmlong = cols['gmlat'][k], cols['gmlong'][k]
+        db.append([float(cols['alt'][k]), float(cols['lat'][k]), float(cols['long'][k]),
+                   np.array(cols['B'][k]),
+                   None if np.isnan(gmlat) else gmlat, None if np.isnan(gmlong) else gmlong,
+                   [], split_items(cols['items'][k])])
+    return db
+
+def cells(lat, long, level):
+    '''Cell numbers of points (arrays of latitude and longitude in rad) in an
+    equal-area grid: at level the sphere is divided into 2**level bands of
+    equal area (equal steps in sin(latitude)) and 2**(level + 1) sectors of
+    longitude, i.e. 2**(2 * level + 1) cells of equal area. The grids are
+    nested, each cell of level + 1 lies in exactly one cell of level.'''
+    n = 2 ** level
+    z = np.sin(np.asarray(lat, dtype=float))
+    iz = np.clip(np.floor((z + 1) / 2 * n).astype(int), 0, n - 1)
+    il = np.floor(np.mod(long, 2 * np.pi) / (2 * np.pi) * 2 * n).astype(int) % (2 * n)
+    return iz * 2 * n + il
+
+def subsamples(lat, long, levels):
+    '''Nested subsamples of points (arrays of latitude and longitude in rad)
+    with about equal density on the sphere. For each level (see cells) an
+    array of indices is returned, one point per occupied cell: the first
+    point of the cell. A point in the subsample of a level is therefore also
+    in the subsamples of all finer levels.'''
+    res = []
+    for level in levels:
+        first = np.unique(cells(lat, long, level), return_index=True)[1]
+        res.append(np.sort(first))
+    return res
+
+def dates(db):
+    '''Dates (item B, decimal years) of all records of db as numpy.array.
+    db is a list of records, Records or a columnar data set (load_columns).'''
+    if isinstance(db, Records):
+        return np.array(db.data['date'])
+    if isinstance(db, dict):
+        return np.array(db['date'], dtype=float)
+    return np.array([float(rec[iitem][1]) for rec in db])
+
     
 # Format description for world-wide magnetic survey data
 # from: http://www.geomag.bgs.ac.uk/data_service/data/pmfformat.html (with minor complements)
@@ -0,0 +1,144 @@
+'''instrument collects counters and timers of simulation runs
+The stages of a run (load, processData, bfield, angle, error) are timed with
+the decorator timed, events such as cache hits or the number of evaluated
+loop segments are counted with count, and the optimizers report the wall
+time of each iteration with iteration. Nothing is collected unless enabled
+is True; then timed costs one attribute lookup per call and count one
+comparison, so the hooks can stay in the code.
+
+start switches the collection on (optionally writing a trace in JSON lines,
+one line per timed call and per iteration, and/or a cProfile dump), stop
+switches it off and returns the report: a dict with the counters and, per
+stage, the number of calls and the total time in s (nested stages are
+included in the time of the outer stage). Counters are kept per process, so
+work done in a process pool (see simulation_magnetfeld.workers) is not
+included.
+
+Example:
+import instrument, simulation_magnetfeld as sm
+with instrument.session(trace='run.jsonl', profile='run.prof') as report:
+    sm.optimzeAngleLoop(1e6, 6e6, 10, 3)
+print(instrument.summary(report))
+'''
+
+import contextlib
+import cProfile
+import functools
+import json
+import time
+
+enabled = False
+counters = {}   # name -> count
+timers = {}     # stage -> [calls, seconds]
+
+__trace__ = None    # open trace file
+__profile__ = None  # (cProfile.Profile, file name)
+__t0__ = 0.0        # time of start, trace times are relative to it
+
+def count(name, k=1):
+    '''Add k to the counter name.'''
+    if enabled:
+        counters[name] = counters.get(name, 0) + k
+
+def add_time(name, t, seconds):
+    '''Add a call of stage name, started at t (time.perf_counter) and taking
+    seconds, to the timers and the trace.'''
+    entry = timers.get(name)
+    if entry is None:
+        timers[name] = [1, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+    if __trace__ is not None:
+        event(stage=name, start=t - __t0__, seconds=seconds)
+
+def timed(name):
+    '''Decorator timing each call of the function as stage name.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, t, time.perf_counter() - t)
+        return wrapper
+    return decorator
+
+def iteration(name, j, seconds, **data):
+    '''Record iteration j of the optimizer name, which took seconds; data
+    (e.g. the current parameters and error) is written to the trace.'''
+    if enabled:
+        add_time(name + '.iteration', time.perf_counter() - seconds, seconds)
+        if __trace__ is not None:
+            event(iteration=name, j=j, seconds=seconds, **data)
+
+def event(**data):
+    '''Write data as one line to the trace (if a trace is written).'''
+    if __trace__ is not None:
+        __trace__.write(json.dumps(data, default=float) + '\n')
+
+def reset():
+    '''Clear all counters and timers.'''
+    counters.clear()
+    timers.clear()
+
+def start(trace=None, profile=None):
+    '''Reset and switch the collection on. trace is a file name for the
+    JSON lines trace, profile a file name for a cProfile dump (see pstats).'''
+    global enabled, __trace__, __profile__, __t0__
+    reset()
+    if trace is not None:
+        __trace__ = open(trace, 'w')
+    if profile is not None:
+        __profile__ = (cProfile.Profile(), profile)
+        __profile__[0].enable()
+    __t0__ = time.perf_counter()
+    enabled = True
+
+def stop():
+    '''Switch the collection off, close the trace, write the profile and
+    return the report.'''
+    global enabled, __trace__, __profile__
+    enabled = False
+    res = report()
+    if __profile__ is not None:
+        __profile__[0].disable()
+        __profile__[0].dump_stats(__profile__[1])
+        __profile__ = None
+    if __trace__ is not None:
+        event(report=res)
+        __trace__.close()
+        __trace__ = None
+    return res
+
+def report():
+    '''Counters and timers as a dict {'counters': {name: count},
+    'timers': {stage: {'calls': calls, 'seconds': seconds}}}.'''
+    return {'counters': dict(counters),
+            'timers': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in timers.items()}}
+
+@contextlib.contextmanager
+def session(trace=None, profile=None):
+    '''Context manager around start and stop; the yielded dict is filled
+    with the report when the block is left.'''
+    res = {}
+    start(trace, profile)
+    try:
+        yield res
+    finally:
+        res.update(stop())
+
+def summary(res=None):
+    '''Report (the current one by default) as a table.'''
+    res = res or report()
+    lines = ['%-32s %10s %12s' % ('stage', 'calls', 'seconds')]
+    for name, t in sorted(res['timers'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append('%-32s %10d %12.6f' % (name, t['calls'], t['seconds']))
+    lines.append('%-32s %10s' % ('counter', 'count'))
+    for name, k in sorted(res['counters'].items()):
+        lines.append('%-32s %10d' % (name, k))
+    return '\n'.join(lines)
@@ -0,0 +1,165 @@
+'''resultcache is a persistent, content-addressed disk cache for fit results
+Results of optimizer runs and the errors of single candidates are stored as
+small JSON files in directory (one file per entry, named by the SHA-256 of
+its key). A key is built by key() from a description of what was computed:
+the kind of result, the hash of the data set (dataset_hash), the model
+parameters and the code version (code_version), so changing any of them
+gives a new entry instead of a stale one.
+
+Entries are written to a temporary file and renamed, so several processes
+can read and write the same cache at the same time; a reader sees either a
+complete entry or none. The cache is bounded to max_bytes, the least
+recently used entries are removed first.
+
+Example:
+import resultcache
+k = resultcache.key('angleError', resultcache.dataset_hash('geodata4.pickle'), 1e9, 4e6)
+err = resultcache.get(k)
+if err is None:
+    err = ...  # compute
+    resultcache.put(k, err)
+'''
+
+import hashlib
+import json
+import os
+
+import instrument
+
+enabled = True              # False: get always misses, put does nothing
+directory = '.fitcache'     # cache directory
+max_bytes = 256 * 1024**2   # size limit of the cache
+evict_interval = 32         # check the size after this many put calls
+
+__puts__ = 0
+__hashes__ = {}             # (path, mtime, size) -> hash of data set
+__codeversion__ = None
+
+def __jsonable__(value):
+    '''Convert numpy scalars, arrays and tuples to plain JSON values.'''
+    if isinstance(value, (list, tuple)):
+        return [__jsonable__(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): __jsonable__(v) for k, v in value.items()}
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+def key(*parts):
+    '''Key (hex string) for the parts, which must be JSON serializable
+    (numpy scalars are converted). Floats are stored exactly.'''
+    text = json.dumps(__jsonable__(list(parts)), sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def dataset_hash(fn):
+    '''SHA-256 of the content of the data set fn (a file or a directory in
+    columnar format). It is computed once per path, mtime and size.'''
+    path = os.path.abspath(fn)
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        sts = [os.stat(os.path.join(path, name)) for name in names]
+        stamp = (path, max([st.st_mtime_ns for st in sts] + [0]), sum(st.st_size for st in sts))
+        files = [os.path.join(path, name) for name in names]
+    else:
+        st = os.stat(path)
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        files = [path]
+    if stamp not in __hashes__:
+        h = hashlib.sha256()
+        for name in files:
+            h.update(os.path.basename(name).encode('utf-8'))
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        __hashes__[stamp] = h.hexdigest()
+    return __hashes__[stamp]
+
+def code_version():
+    '''Hash of the source of the simulation code (geo.py and
+    simulation_magnetfeld.py), so results of other code versions are not
+    reused.'''
+    global __codeversion__
+    if __codeversion__ is None:
+        h = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ['geo.py', 'simulation_magnetfeld.py']:
+            with open(os.path.join(here, name), 'rb') as f:
+                h.update(f.read())
+        __codeversion__ = h.hexdigest()[:16]
+    return __codeversion__
+
+def __entry__(k):
+    return os.path.join(directory, k[:2], k + '.json')
+
+def get(k):
+    '''Value stored under key k or None.'''
+    if not enabled:
+        return None
+    fn = __entry__(k)
+    try:
+        with open(fn) as f:
+            value = json.load(f)
+        os.utime(fn)  # mark as recently used
+        instrument.count('resultcache.hit')
+        return value
+    except (OSError, ValueError):
+        instrument.count('resultcache.miss')
+        return None
+
+def put(k, value):
+    '''Store value (JSON serializable, see key) under key k.'''
+    global __puts__
+    if not enabled:
+        return
+    fn = __entry__(k)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(__jsonable__(value), f)
+    os.replace(tmp, fn)
+    __puts__ += 1
+    if __puts__ % evict_interval == 0:
+        evict()
+
+def evict(limit=None):
+    '''Remove the least recently used entries until the cache is smaller
+    than limit (max_bytes by default).'''
+    limit = max_bytes if limit is None else limit
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            fn = os.path.join(root, name)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue  # removed by another process
+            entries.append((st.st_mtime, st.st_size, fn))
+    total = sum(e[1] for e in entries)
+    for mtime, size, fn in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+        total -= size
+
+def clear():
+    '''Remove all entries.'''
+    evict(0)
+
+def candidates(kind, params, values, compute):
+    '''Results for a list of candidate values, e.g. the error for each
+    radius of a sweep. Cached results are taken from the cache, compute is
+    called once with the list of the missing candidates and has to return
+    their results in the same order. kind and params describe the sweep
+    (see key).'''
+    keys = [key(kind, params, v) for v in values]
+    results = [get(k) for k in keys]
+    missing = [j for j, r in enumerate(results) if r is None]
+    if missing:
+        computed = compute([values[j] for j in missing])
+        for j, r in zip(missing, computed):
+            put(keys[j], r)
+            results[j] = r
+    return results
@@ -15,9 +15,25 @@ zuerst der Winkel (Kreisradius) optimiert wird und danach die Stromstärke.
 '''
 
 # Import Module & Daten
-from numpy import array, pi, sin, cos, arcsin, arccos, cross, dot, sqrt
-from numpy.linalg import norm
+from numpy import array, asarray, argsort, searchsorted, unique, einsum, diag, atleast_1d, arange, empty, zeros, unravel_index, prod, ones_like, full, concatenate, newaxis, where, pi, sin, cos, arcsin, arccos, cross, dot, sqrt
+from numpy.linalg import norm, solve, LinAlgError
+from numpy.lib.format import open_memmap
+from collections import OrderedDict
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import os
+import threading
+import warnings
 import geo
+import resultcache
+import instrument
+
+# Numba ist optional (kompilierter Kern für das segmentierte Modell, siehe segmentsKernel)
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # Globale Variablen
 mu0 = 4 * pi * 1e-7  # magn. Feldkonstante
@@ -26,6 +42,65 @@ re = 6.3710e6        # Erdradius
 # Verwendete Pickle-Datei
 pickle = 'geodata4.pickle'
 
+# Zwischenspeicher für geladene & verarbeitete Messdaten (siehe loadData)
+data_cache = OrderedDict()  # Pfad -> ((mtime, Grösse), verarbeitete Daten)
+data_cache_size = 4         # maximale Anzahl gespeicherter Datensätze
+
+# Zwischenspeicher für die Geometrie der Kreisabschnitte (siehe segmentGeometry)
+segment_cache = OrderedDict()  # (Kreisradius, Auflösung) -> (rp1, rp2, rl)
+segment_cache_size = 64        # maximale Anzahl gespeicherter Geometrien
+
+# Zwischenspeicher für die Koeffizienten der Multipolentwicklung (siehe multipoleCoefficients)
+multipole_cache = OrderedDict()  # Grad -> (Grade, normierte Koeffizienten, c_k)
+multipole_cache_size = 64
+
+# Pro Datensatz vorberechnete Grössen der Messdaten (siehe prepareData)
+prepared_cache = OrderedDict()  # Pfad -> (verarbeitete Daten, vorberechnete Grössen)
+
+# Gleichmässig verteilte Teilmengen der Messdaten (siehe prepareData & geo.subsamples)
+subsample_cache = OrderedDict()  # (Pfad, Stufe) -> (vorberechnete Grössen, Teilmenge davon)
+subsample_cache_size = 16
+
+# Die Zwischenspeicher werden auch aus mehreren Threads verwendet (siehe mapCandidates), daher
+# werden Nachschlagen & Einfügen (inkl. Reihenfolge & Verwerfen) durch eine Sperre geschützt
+cache_lock = threading.Lock()
+
+# Eintrag key aus dem Zwischenspeicher cache (None falls nicht vorhanden) & als zuletzt
+# verwendet markieren
+def cacheGet(cache, key):
+    with cache_lock:
+        entry = cache.get(key)
+        if (entry is not None):
+            cache.move_to_end(key)
+        return entry
+
+# Eintrag key im Zwischenspeicher cache speichern & die am längsten nicht verwendeten Einträge
+# verwerfen, bis höchstens size Einträge übrig sind
+def cachePut(cache, key, entry, size):
+    with cache_lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        while (len(cache) > size):
+            cache.popitem(last=False)
+
+# Parallele Auswertung der Kandidaten (Radien bzw. Ströme) in den Optimierungen
+workers = 1          # Anzahl Prozesse/Threads, 1: seriell
+backend = 'process'  # 'process' (ProcessPoolExecutor) oder 'thread' (ThreadPoolExecutor)
+pools = {}           # offene Pools, (backend, workers) -> Executor
+
+# Verwendetes Feldmodell der Leiterschleife:
+#  'segments' -> Kreis in n gerade Abschnitte unterteilt (Biot-Savart Summe)
+#  'exact'    -> exakter Kreisstrom mittels vollständiger elliptischer Integrale K & E
+fieldmodel = 'segments'
+
+# Kern des segmentierten Modells:
+#  'auto'  -> mit Numba kompilierter Kern (segmentsKernel), falls Numba installiert ist und
+#             der Kern beim ersten Gebrauch mit NumPy übereinstimmt, sonst NumPy
+#  'numpy' -> immer NumPy-Broadcasting
+kernel = 'auto'
+kernel_rtol = 1e-10  # erlaubte relative Abweichung des kompilierten Kerns von NumPy
+jit_kernel = None    # kompilierter & geprüfter Kern, False: nicht verfügbar
+
 # Funktion um 3d-Vektor zu erstellen
 def vec3d(x, y, z):
     return array([x, y, z])
@@ -43,50 +118,527 @@ def toCart(lg, bg, h):
         r * sin(bg)
     )
 
-# Magnetfeld berechnen (Längengrad [°], Breitengrad [°], Höhe [m], Stromstärke [A], Kreisradius [m])
-def bfield(lg, bg, h, i, cr):
-
-    # Vektor vom Ursprung zum Punkt P (lg, bg, h)
-    rp = toCart(lg, bg, h)
+# Vektoren aus Arrays von Höhen, Längen- & Breitengraden, Resultat als (N, 3)-Array
+def toCartBatch(lgs, bgs, hs):
+    lgs = atleast_1d(asarray(lgs, dtype=float)) / 180 * pi  # Längengrade als rad
+    bgs = atleast_1d(asarray(bgs, dtype=float)) / 180 * pi  # Breitengrade als rad
+    rs = re + atleast_1d(asarray(hs, dtype=float))          # Abstände vom Origo
+
+    # Resultat: eine Zeile pro Punkt
+    res = empty((len(rs), 3))
+    res[:, 0] = rs * cos(bgs) * cos(lgs)
+    res[:, 1] = rs * cos(bgs) * sin(lgs)
+    res[:, 2] = rs * sin(bgs)
+    return res
+
+# Geometrie der n Kreisabschnitte eines Kreises mit Radius cr: Vektoren vom Origo zu P1 & P2
+# und Vektoren der Abschnitte, je ein (n, 3)-Array. Die Arrays werden pro (cr, n) nur einmal
+# berechnet und im Zwischenspeicher behalten (höchstens segment_cache_size Einträge, der am
+# längsten nicht verwendete wird zuerst verworfen). Sie sind schreibgeschützt.
+def segmentGeometry(cr, n=100):
+    key = (float(cr), int(n))
+
+    # Treffer
+    entry = cacheGet(segment_cache, key)
+    if (entry is not None):
+        instrument.count('segment_cache.hit')
+        return entry
+    instrument.count('segment_cache.miss')
 
-    # Magnetfeld als Nullvektor
-    B = vec3d(0.0, 0.0, 0.0)
-
-    n = 100            # Auflösung, wie oft Kreis unterteilt wird
     step = 2 * pi / n  # Schrittgrösse, wie gross jedes Kreisfragment ist
 
-    # Einfluss der einzelnen Leiterschleifen-Abschnitte
-    # Ein Abschnitt wird durch zwei Punkte (P1 & P2) beschrieben
-    for k in range(n):
+    # Vektoren vom Origo zu P1 & P2 aller Abschnitte
+    ks = arange(n)
+    rp1 = empty((n, 3))
+    rp1[:, 0] = cos(ks * step) * cr
+    rp1[:, 1] = sin(ks * step) * cr
+    rp1[:, 2] = 0
+    rp2 = empty((n, 3))
+    rp2[:, 0] = cos((ks + 1) * step) * cr
+    rp2[:, 1] = sin((ks + 1) * step) * cr
+    rp2[:, 2] = 0
+
+    # Vektoren der Kreisabschnitte
+    rl = rp2 - rp1
+
+    for a in (rp1, rp2, rl):
+        a.flags.writeable = False
+    entry = (rp1, rp2, rl)
+    cachePut(segment_cache, key, entry, segment_cache_size)
+
+    return entry
+
+# Magnetfeld an vielen Punkten gleichzeitig berechnen (Arrays von Längengraden [°], Breiten-
+# graden [°] & Höhen [m], Stromstärke [A], Kreisradius [m]). Resultat ist ein (N, 3)-Array.
+# model wählt das Feldmodell ('segments' oder 'exact', keine Angabe: fieldmodel). Mit rtol
+# wird im segmentierten Modell die Auflösung pro Punkt automatisch gewählt, siehe
+# bfieldAdaptiveBatch; n wird dann ignoriert. Mit full_output wird (B, ns, errs) zurückgegeben:
+# Auflösung & geschätzter relativer Fehler pro Punkt (ohne rtol: n & nan, exaktes Modell: 0 & 0).
+@instrument.timed('bfield')
+def bfieldBatch(lgs, bgs, hs, i, cr, model=None, n=100, chunk=2048, rtol=None, full_output=False):
+    model = model or fieldmodel
+
+    if (model == 'segments' and rtol is not None):
+        res = bfieldAdaptiveBatch(lgs, bgs, hs, i, cr, rtol, chunk=chunk)
+        return res if full_output else res[0]
+    elif (model == 'segments'):
+        B = bfieldSegmentsBatch(lgs, bgs, hs, i, cr, n, chunk)
+        return (B, full(len(B), n), full(len(B), float('nan'))) if full_output else B
+    elif (model == 'exact'):
+        B = bfieldExactBatch(lgs, bgs, hs, i, cr)
+        return (B, zeros(len(B), dtype=int), zeros(len(B))) if full_output else B
+    raise ValueError('unbekanntes Feldmodell: ' + str(model))
+
+# Segmentiertes Modell: Alle Punkte & alle Kreisabschnitte werden mit NumPy-Broadcasting auf
+# einmal gerechnet; die Punkte werden in Blöcken zu chunk Stück verarbeitet, damit die
+# (chunk, n, 3)-Zwischenresultate den Speicher nicht sprengen.
+def bfieldSegmentsBatch(lgs, bgs, hs, i, cr, n=100, chunk=2048):
+
+    # Vektoren vom Ursprung zu den Punkten P
+    rps = toCartBatch(lgs, bgs, hs)
+
+    # Alle Kreisabschnitte auf einmal (Shape (n, 3)), aus dem Zwischenspeicher
+    rp1, rp2, rl = segmentGeometry(cr, n)
+    instrument.count('bfield.points', len(rps))
+    instrument.count('segments', len(rps) * n)
+
+    # Magnetfelder aller Punkte
+    B = empty((len(rps), 3))
+
+    # Kompilierter Kern: ohne Zwischenresultate, keine Blöcke nötig
+    if (kernel == 'auto' and compiledKernel()):
+        jit_kernel(rps, rp1, rl, mu0 * i / 4 / pi, B)
+        return B
+
+    for s in range(0, len(rps), chunk):
+        # Vektoren von den Punkten P1 zu den Punkten P, Shape (chunk, n, 3)
+        rp1p = rps[s:s + chunk, newaxis, :] - rp1[newaxis, :, :]
+
+        # Beiträge aller Kreisabschnitte werden pro Punkt aufsummiert
+        d3 = norm(rp1p, axis=2)**3
+        B[s:s + chunk] = mu0 * i / 4 / pi * (cross(rl, rp1p) / d3[:, :, newaxis]).sum(axis=1)
+
+    # Rückgabe berechnete Magnetfelder
+    return B
 
-        # Vektor vom Origo zu P1
-        rp1  = vec3d(
-            cos(k * step), 
-            sin(k * step), 
-            0
-        ) * cr
+# Kern des segmentierten Modells für Numba: pro Punkt P werden die Beiträge aller Kreisab-
+# schnitte direkt aufsummiert (Kreuzprodukt rl x (P - P1) / |P - P1|^3), ohne (N, n, 3)-
+# Zwischenresultate; die Punkte werden parallel abgearbeitet (prange). Resultat c * Summe in
+# out. Ohne Numba läuft der Kern als (langsames) Python, z.B. zum Testen.
+def segmentsKernel(rps, rp1, rl, c, out):
+    for k in prange(rps.shape[0]):
+        bx = 0.0
+        by = 0.0
+        bz = 0.0
+        for j in range(rp1.shape[0]):
+            dx = rps[k, 0] - rp1[j, 0]
+            dy = rps[k, 1] - rp1[j, 1]
+            dz = rps[k, 2] - rp1[j, 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            f = 1.0 / (d2 * sqrt(d2))
+            bx += (rl[j, 1] * dz - rl[j, 2] * dy) * f
+            by += (rl[j, 2] * dx - rl[j, 0] * dz) * f
+            bz += (rl[j, 0] * dy - rl[j, 1] * dx) * f
+        out[k, 0] = c * bx
+        out[k, 1] = c * by
+        out[k, 2] = c * bz
+
+if (numba is not None):
+    prange = numba.prange
+else:
+    prange = range
+
+# Kompilierten Kern beim ersten Gebrauch erstellen & mit NumPy vergleichen (einige Punkte in
+# verschiedenen Abständen zum Leiter). Nur wenn alles klappt, wird er verwendet; sonst (kein
+# Numba, Fehler beim Kompilieren, Abweichung > kernel_rtol) wird NumPy verwendet.
+# Rückgabe: True, falls der kompilierte Kern verfügbar ist.
+def compiledKernel():
+    global jit_kernel
+    if (jit_kernel is None):
+        jit_kernel = False
+        if (numba is not None):
+            try:
+                func = numba.njit(parallel=True, cache=True)(segmentsKernel)
+                lgs = arange(-180, 180, 15.0)
+                bgs = (arange(len(lgs)) * 37.0) % 180 - 90
+                hs = arange(len(lgs)) * 1e5
+                for cr in (1e6, 5e6):
+                    B = bfieldKernelCheck(func, lgs, bgs, hs, cr)
+                    B_np = bfieldSegmentsBatch(lgs, bgs, hs, 1.0, cr)
+                    if (norm(B - B_np, axis=1) > kernel_rtol * norm(B_np, axis=1)).any():
+                        raise ValueError('Abweichung von NumPy grösser als ' + str(kernel_rtol))
+                jit_kernel = func
+            except Exception as e:
+                warnings.warn('kompilierter Kern nicht verwendet: ' + str(e))
+    return jit_kernel is not False
+
+# Feld (I = 1 A) mit dem Kern func an den Punkten, zum Prüfen in compiledKernel
+def bfieldKernelCheck(func, lgs, bgs, hs, cr, n=100):
+    rps = toCartBatch(lgs, bgs, hs)
+    rp1, rp2, rl = segmentGeometry(cr, n)
+    B = empty((len(rps), 3))
+    func(rps, rp1, rl, mu0 / 4 / pi, B)
+    return B
 
-        # Vektor vom Origo zu P2
-        rp2  = vec3d(
-            cos((k + 1) * step), 
-            sin((k + 1) * step), 
-            0
-        ) * cr
+# Segmentiertes Modell mit automatischer Auflösung: Die Summe über n Abschnitte ist eine
+# Potenzreihe in der Schrittgrösse 2 pi / n (der Fehler ist proportional zu 1/n, da jeder
+# Abschnitt von seinem Startpunkt P1 aus gerechnet wird). Daher wird die Auflösung ausgehend
+# von n0 verdoppelt & mit Richardson-Extrapolation (Romberg-Schema mit Faktoren 2^j) kombi-
+# niert. Ein Punkt ist fertig, wenn sich der extrapolierte Wert von einer Verdoppelung zur
+# nächsten um höchstens rtol (relativ zu |B|) ändert, spätestens bei nmax.
+# Rückgabe: B als (N, 3)-Array, die pro Punkt verwendete (feinste) Auflösung & der geschätzte
+# relative Fehler. Die Zähler bfield.adaptive.* (instrument) halten fest, wie viele Punkte
+# rtol nicht erreicht haben.
+def bfieldAdaptiveBatch(lgs, bgs, hs, i, cr, rtol=1e-6, n0=16, nmax=8192, chunk=2048, order=6):
+    lgs = atleast_1d(asarray(lgs, dtype=float))
+    bgs = atleast_1d(asarray(bgs, dtype=float))
+    hs = atleast_1d(asarray(hs, dtype=float))
+
+    B = empty((len(lgs), 3))
+    ns = zeros(len(lgs), dtype=int)
+    errs = zeros(len(lgs))
+
+    # Noch nicht genügend genaue Punkte & deren letzte Zeile im Romberg-Schema
+    active = arange(len(lgs))
+    n = n0
+    row = [bfieldSegmentsBatch(lgs, bgs, hs, i, cr, n, chunk)]
+
+    while (len(active) > 0):
+        # Nächste Zeile nur für die aktiven Punkte
+        n *= 2
+        new = [bfieldSegmentsBatch(lgs[active], bgs[active], hs[active], i, cr, n, chunk)]
+        for j in range(1, min(len(row) + 1, order + 1)):
+            new.append((2**j * new[j - 1] - row[j - 1]) / (2**j - 1))
+        err = norm(new[-1] - row[-1], axis=1) / norm(new[-1], axis=1)
+
+        # Fertig: genau genug oder maximale Auflösung erreicht
+        done = (err <= rtol) | (n >= nmax)
+        B[active[done]] = new[-1][done]
+        ns[active[done]] = n
+        errs[active[done]] = err[done]
+
+        active = active[~done]
+        row = [r[~done] for r in new]
+
+    # Punkte, die rtol auch mit nmax Abschnitten nicht erreichen
+    instrument.count('bfield.adaptive.points', len(lgs))
+    instrument.count('bfield.adaptive.unconverged', int((errs > rtol).sum()))
+    return B, ns, errs
+
+# Magnetfeld & dessen Ableitung nach dem Kreisradius an vielen Punkten (wie bfieldBatch).
+# Rückgabe: B & dB/dcr, beides (N, 3)-Arrays. Für das segmentierte Modell wird die Ableitung
+# analytisch berechnet: mit rp1 = cr * c & rl = cr * dc gilt für jeden Abschnitt
+#   d/dcr [rl x d / |d|^3] = rl x (d - rp1) / (cr |d|^3) + 3 (rl x d)(d . rp1) / (cr |d|^5),
+# wobei d = rp - rp1. Für das exakte Modell mit zentralen Differenzen.
+@instrument.timed('bfield')
+def bfieldGradBatch(lgs, bgs, hs, i, cr, model=None, n=100, chunk=2048):
+    model = model or fieldmodel
+
+    if (model == 'exact'):
+        h = 1e-6 * cr
+        B = bfieldExactBatch(lgs, bgs, hs, i, cr)
+        dB = (bfieldExactBatch(lgs, bgs, hs, i, cr + h)
+              - bfieldExactBatch(lgs, bgs, hs, i, cr - h)) / (2 * h)
+        return B, dB
+    elif (model != 'segments'):
+        raise ValueError('unbekanntes Feldmodell: ' + str(model))
+
+    rps = toCartBatch(lgs, bgs, hs)
+
+    # Kreisabschnitte wie in bfieldSegmentsBatch
+    rp1, rp2, rl = segmentGeometry(cr, n)
+    instrument.count('bfield.points', len(rps))
+    instrument.count('segments', len(rps) * n)
+
+    B = empty((len(rps), 3))
+    dB = empty((len(rps), 3))
+
+    for s in range(0, len(rps), chunk):
+        rp1p = rps[s:s + chunk, newaxis, :] - rp1[newaxis, :, :]
+        d2 = (rp1p**2).sum(axis=2)
+        d3 = (d2 * sqrt(d2))[:, :, newaxis]
+        c = cross(rl, rp1p)
+
+        # Feld & Ableitung, Beiträge aller Abschnitte aufsummiert
+        B[s:s + chunk] = mu0 * i / 4 / pi * (c / d3).sum(axis=1)
+        dot1 = (rp1p * rp1).sum(axis=2)[:, :, newaxis]
+        dB[s:s + chunk] = mu0 * i / 4 / pi / cr * (
+            cross(rl, rp1p - rp1) / d3 + 3 * c * dot1 / (d3 * d2[:, :, newaxis])).sum(axis=1)
+
+    return B, dB
+
+# Vollständige elliptische Integrale K(m) & E(m) (Parameter m = k^2) für ganze Arrays, mittels
+# arithmetisch-geometrischem Mittel (AGM). Konvergiert quadratisch, d.h. nach wenigen Schritten
+# ist die Maschinengenauigkeit erreicht.
+def ellipticKE(m):
+    a = ones_like(m)
+    b = sqrt(1 - m)
+    c2 = m.copy()   # c_0^2 = m
+    s = 0.5 * c2    # Summe 2^(j-1) * c_j^2
+    w = 0.5
+
+    for j in range(32):
+        if (c2.max(initial=0) <= 1e-32):
+            break
+        c = (a - b) / 2
+        a, b = (a + b) / 2, sqrt(a * b)
+        w *= 2
+        c2 = c * c
+        s += w * c2
+
+    K = pi / 2 / a
+    return K, K * (1 - s)
+
+# Exaktes Modell: Feld eines kreisförmigen Leiters (Radius cr, in der Ebene z = 0, Zentrum im
+# Origo) in geschlossener Form, siehe z.B. Simpson et al., "Simple Analytic Expressions for
+# the Magnetic Field of a Circular Current Loop" (NASA 2001). Pro Punkt werden nur K & E
+# ausgewertet statt n Kreisabschnitte.
+def bfieldExactBatch(lgs, bgs, hs, i, cr):
+
+    # Vektoren vom Ursprung zu den Punkten P, Zylinderkoordinaten
+    rps = toCartBatch(lgs, bgs, hs)
+    instrument.count('bfield.points', len(rps))
+    x, y, z = rps[:, 0], rps[:, 1], rps[:, 2]
+    rho2 = x**2 + y**2
+    rho = sqrt(rho2)
+    r2 = rho2 + z**2
+
+    alpha2 = cr**2 + r2 - 2 * cr * rho  # kleinster Abstand zum Leiter im Quadrat
+    beta2 = cr**2 + r2 + 2 * cr * rho   # grösster Abstand zum Leiter im Quadrat
+    beta = sqrt(beta2)
+    K, E = ellipticKE(1 - alpha2 / beta2)
+
+    c = mu0 * i / pi / (2 * alpha2 * beta)
+    bz = c * ((cr**2 - r2) * E + alpha2 * K)
+
+    # Radialkomponente; auf der z-Achse (rho = 0) verschwindet sie
+    on_axis = rho == 0
+    brho = c * z * ((cr**2 + r2) * E - alpha2 * K) / where(on_axis, 1, rho2)
+    brho[on_axis] = 0
+
+    # Resultat in kartesischen Koordinaten
+    B = empty((len(rps), 3))
+    B[:, 0] = brho * x
+    B[:, 1] = brho * y
+    B[:, 2] = bz
+    return B
 
-        # Vektor eines Kreisabschnitts
-        rl = rp2 - rp1
+'''
+====================================== FELDQUELLEN ========================================
+Statt einer einzelnen Leiterschleife im Zentrum der Erde können mehrere Quellen kombiniert 
+werden: Leiterschleifen mit eigenem Radius, Strom, Zentrum & Neigung sowie Punktdipole. 
+Eine Quelle ist ein dict (erstellt mit loop(...) oder dipole(...)), ein Modell eine Liste 
+von Quellen. sourceGeometry rechnet ein Modell einmal in Arrays um (alle Kreisabschnitte 
+aller Schleifen aneinandergereiht), danach wird das Feld aller Quellen mit bfieldSources-
+Batch in einem Durchgang pro Block von Punkten berechnet.
+============================================================================================
+'''
+
+# Leiterschleife: Radius cr [m], Strom i [A], Zentrum [m] (kartesisch), Neigung der Normalen
+# gegenüber der z-Achse & deren Azimut in Grad. Ohne Angaben wie in bfield.
+def loop(cr, i, center=(0, 0, 0), tilt=0, azimuth=0):
+    return {'type': 'loop', 'cr': cr, 'i': i, 'center': asarray(center, dtype=float),
+            'tilt': tilt, 'azimuth': azimuth}
+
+# Punktdipol: magnetisches Moment m [A m^2] (kartesisch), Zentrum [m]
+def dipole(m, center=(0, 0, 0)):
+    return {'type': 'dipole', 'm': asarray(m, dtype=float), 'center': asarray(center, dtype=float)}
+
+# Geometrie eines Modells (Liste von Quellen), jede Schleife in n Abschnitte unterteilt.
+# Rückgabe: dict mit den Startpunkten rp1 & Vektoren rl aller Abschnitte, dem Strom pro
+# Abschnitt sowie den Zentren & Momenten der Dipole.
+def sourceGeometry(sources, n=100):
+    rp1s, rls, currents = [], [], []
+    centers, moments = [], []
+
+    for src in sources:
+        if (src['type'] == 'loop'):
+            # Normalenvektor & zwei Vektoren in der Ebene der Schleife (ohne Neigung: x, y, z)
+            t = src['tilt'] / 180 * pi
+            a = src['azimuth'] / 180 * pi
+            ez = array([sin(t) * cos(a), sin(t) * sin(a), cos(t)])
+            ex = cross([0.0, 1.0, 0.0], ez)
+            if (norm(ex) < 1e-12):
+                ex = cross([1.0, 0.0, 0.0], ez)
+            ex = ex / norm(ex)
+            ey = cross(ez, ex)
+
+            # Kreisabschnitte aus segmentGeometry, in die Ebene der Schleife gedreht & verschoben
+            c1, c2, cl = segmentGeometry(src['cr'], n)
+            rp1 = c1[:, 0:1] * ex + c1[:, 1:2] * ey
+            rp2 = c2[:, 0:1] * ex + c2[:, 1:2] * ey
+            rp1s.append(rp1 + src['center'])
+            rls.append(rp2 - rp1)
+            currents.append(full(n, float(src['i'])))
+        elif (src['type'] == 'dipole'):
+            centers.append(src['center'])
+            moments.append(src['m'])
+        else:
+            raise ValueError('unbekannte Quelle: ' + str(src['type']))
+
+    return {'rp1': concatenate(rp1s) if rp1s else empty((0, 3)),
+            'rl': concatenate(rls) if rls else empty((0, 3)),
+            'i': concatenate(currents) if currents else empty(0),
+            'centers': array(centers).reshape(-1, 3),
+            'moments': array(moments).reshape(-1, 3)}
+
+# Summe der Felder aller Quellen an vielen Punkten (Arrays wie bfieldBatch). geometry ist
+# entweder eine Liste von Quellen oder (schneller bei wiederholten Aufrufen) das Resultat
+# von sourceGeometry. Resultat ist ein (N, 3)-Array.
+@instrument.timed('bfield')
+def bfieldSourcesBatch(lgs, bgs, hs, geometry, n=100, chunk=None):
+    if (not isinstance(geometry, dict)):
+        geometry = sourceGeometry(geometry, n)
+    rp1, rl, cur = geometry['rp1'], geometry['rl'], geometry['i']
+    centers, moments = geometry['centers'], geometry['moments']
+
+    rps = toCartBatch(lgs, bgs, hs)
+    B = zeros((len(rps), 3))
+
+    # Blockgrösse so, dass (chunk, Abschnitte, 3) etwa gleich gross ist wie in bfieldBatch
+    chunk = chunk or max(1, 2048 * 100 // max(1, len(rp1)))
+
+    for s in range(0, len(rps), chunk):
+        rp = rps[s:s + chunk]
+
+        # Alle Kreisabschnitte aller Schleifen (Biot-Savart)
+        if (len(rp1) > 0):
+            rp1p = rp[:, newaxis, :] - rp1[newaxis, :, :]
+            d3 = norm(rp1p, axis=2)**3
+            B[s:s + chunk] += mu0 / 4 / pi * (cur[newaxis, :, newaxis] * cross(rl, rp1p)
+                                               / d3[:, :, newaxis]).sum(axis=1)
+
+        # Alle Dipole: B = mu0 / 4pi * (3 r (m . r) / |r|^5 - m / |r|^3)
+        if (len(centers) > 0):
+            r = rp[:, newaxis, :] - centers[newaxis, :, :]
+            d = norm(r, axis=2)[:, :, newaxis]
+            mr = (r * moments[newaxis, :, :]).sum(axis=2)[:, :, newaxis]
+            B[s:s + chunk] += mu0 / 4 / pi * (3 * r * mr / d**5 - moments[newaxis] / d**3).sum(axis=1)
 
-        # Vektor vom Punkt P1 zum Punkt P
-        rp1p = rp - rp1
+    return B
 
-        # Feldstärke auf Punkt P vom Kreisabschnitt (P1-P2) wird zum Resultat addiert
-        B += mu0 * i / 4 / pi * cross(rl, rp1p) / norm(rp1p)**3
+'''
+=================================== MULTIPOLENTWICKLUNG ===================================
+Ausserhalb der Kugel mit Radius cr lässt sich das Feld der Leiterschleife als Gradient eines 
+Skalarpotentials in zonalen Kugelfunktionen schreiben (nur ungerade Grade l):
+    V(r, theta) = Summe A_l r^-(l+1) P_l(cos theta),   B = -grad V
+Die Koeffizienten folgen aus dem Feld auf der z-Achse, B_z = mu0 I cr^2 / 2 (cr^2 + z^2)^-3/2:
+    A_l = mu0 I c_k cr^(l+1) / (2 (l + 1)),   l = 2k + 1,   c_k = binom(-3/2, k)
+Pro Punkt sind nur ein paar Multiplikationen (Rekursion der Legendre-Polynome) nötig. Die 
+Reihe konvergiert wie (cr / r)^l; wo der erste weggelassene Term nicht klein genug ist, wird 
+das Feld direkt mit bfieldBatch berechnet, standardmässig mit dem Modell 'exact', denn die 
+Entwicklung beschreibt ebenfalls den idealen Kreisstrom.
+============================================================================================
+'''
 
-    # Rückgabe berechnetes Magnetfeld am Punkt P
+# Normierte Koeffizienten a_l = A_l / (I cr^(l+1)) der Multipolentwicklung bis zum Grad degree
+# (unabhängig von cr, daher ohne Überlauf für grosse l). Rückgabe: ungerade Grade l & Koeffi-
+# zienten (je ein Array) sowie c_k des ersten weggelassenen Terms, einmal pro Grad berechnet.
+def multipoleCoefficients(degree=25):
+    key = int(degree)
+    entry = cacheGet(multipole_cache, key)
+    if (entry is not None):
+        instrument.count('multipole_cache.hit')
+        return entry
+    instrument.count('multipole_cache.miss')
+
+    ls = arange(1, degree + 1, 2)
+    coefs = empty(len(ls))
+    c = 1.0  # binom(-3/2, 0)
+    for k, l in enumerate(ls):
+        coefs[k] = mu0 * c / (2 * (l + 1))
+        c *= (-1.5 - k) / (k + 1)  # binom(-3/2, k + 1)
+
+    entry = (ls, coefs, c)
+    cachePut(multipole_cache, key, entry, multipole_cache_size)
+    return entry
+
+# Kleinster (ungerader) Grad, bei dem der geschätzte relative Abbruchfehler für q = cr / r
+# höchstens tol ist, jedoch höchstens maxdegree
+def multipoleDegree(q, tol=1e-8, maxdegree=201):
+    c = 1.0
+    for k in range(maxdegree // 2 + 1):
+        c *= (-1.5 - k) / (k + 1)  # c_(k+1) des ersten weggelassenen Terms
+        l_next = 2 * k + 3
+        if (abs(c) * (l_next + 1) / 2 * q**(l_next - 1) <= tol):
+            return 2 * k + 1
+    return maxdegree
+
+# Magnetfeld an vielen Punkten mit der Multipolentwicklung bis zum Grad degree (Arrays wie
+# bfieldBatch). Ohne Angabe von degree wird der Grad mit multipoleDegree so gewählt, dass
+# der Abbruchfehler am nächsten Punkt ausserhalb der Kugel mit Radius cr höchstens tol ist
+# (höchstens maxdegree). Punkte, an denen der geschätzte relative Abbruchfehler grösser als
+# tol ist, werden direkt mit bfieldBatch (Feldmodell model, wie die Entwicklung exakt)
+# berechnet. Resultat ist ein (N, 3)-Array.
+# Anwendungsbereich: die Reihe konvergiert wie (cr / r)^l. An der Erdoberfläche ist cr / r
+# mit cr = 5e6 m etwa 0.8, dann sind für tol = 1e-8 rund 80 Grade nötig; für Punkte weit
+# ausserhalb (Satelliten, Feldkarten in grosser Höhe) genügen wenige Grade.
+def bfieldMultipoleBatch(lgs, bgs, hs, i, cr, degree=None, tol=1e-8, model='exact', maxdegree=201):
+    rps = toCartBatch(lgs, bgs, hs)
+    r = norm(rps, axis=1)
+    x = rps[:, 2] / r  # cos(theta)
+
+    # Grad für den nächsten Punkt ausserhalb der Kugel
+    if (degree is None):
+        outside = r[r > cr]
+        degree = multipoleDegree(cr / outside.min(), tol, maxdegree) if len(outside) else 1
+    ls, coefs, c_next = multipoleCoefficients(degree)
+
+    # Abbruchfehler: erster weggelassener Term relativ zum Dipolterm
+    l_next = ls[-1] + 2
+    est = abs(c_next) * (l_next + 1) / 2 * (cr / r)**(l_next - 1)
+    far = (r > cr) & (est <= tol)
+
+    # Legendre-Polynome P_l & Ableitungen P_l' mit Rekursion, summiert über ungerade l. Die
+    # Terme A_l r^-(l+2) = I a_l (cr / r)^(l+1) / r werden mit Potenzen von cr / r gerechnet.
+    xf, rf = x[far], r[far]
+    q2 = (cr / rf)**2
+    qpow = q2.copy()                            # (cr / r)^(l+1) für l = 1
+    p_prev, p = ones_like(xf), xf.copy()       # P_0, P_1
+    dp_prev, dp = zeros(len(xf)), ones_like(xf)  # P_0', P_1'
+    br = zeros(len(xf))
+    bt = zeros(len(xf))  # Summe A_l r^-(l+2) P_l' / I, ohne Faktor sin(theta)
+    k = 0
+    for l in range(1, degree + 1):
+        if (l % 2 == 1):
+            br += coefs[k] * (l + 1) * qpow * p
+            bt += coefs[k] * qpow * dp
+            qpow *= q2
+            k += 1
+        # P_(l+1) & P_(l+1)'
+        p_prev, p = p, ((2 * l + 1) * xf * p - l * p_prev) / (l + 1)
+        dp_prev, dp = dp, dp_prev + (2 * l + 1) * p_prev
+    br /= rf
+    bt /= rf
+
+    # Kugelkoordinaten zu kartesischen: B = B_r e_r + B_theta e_theta, mit
+    # sin(theta) e_theta = (x p_x / r, x p_y / r, -(p_x^2 + p_y^2) / r^2)
+    pf = rps[far]
+    B = empty((len(rps), 3))
+    B[far, 0] = i * (br * pf[:, 0] / rf + bt * xf * pf[:, 0] / rf)
+    B[far, 1] = i * (br * pf[:, 1] / rf + bt * xf * pf[:, 1] / rf)
+    B[far, 2] = i * (br * xf - bt * (pf[:, 0]**2 + pf[:, 1]**2) / rf**2)
+
+    # Zu nahe Punkte direkt berechnen
+    near = ~far
+    if (near.any()):
+        B[near] = bfieldBatch(asarray(lgs, dtype=float).reshape(-1)[near],
+                              asarray(bgs, dtype=float).reshape(-1)[near],
+                              asarray(hs, dtype=float).reshape(-1)[near], i, cr, model)
     return B
 
+# Magnetfeld berechnen (Längengrad [°], Breitengrad [°], Höhe [m], Stromstärke [A], Kreisradius [m])
+def bfield(lg, bg, h, i, cr, model=None, rtol=None, full_output=False):
+
+    # Einzelner Punkt wird als Block mit einem Punkt berechnet (full_output: siehe bfieldBatch)
+    if (full_output):
+        B, ns, errs = bfieldBatch([lg], [bg], [h], i, cr, model, rtol=rtol, full_output=True)
+        return B[0], ns[0], errs[0]
+    return bfieldBatch([lg], [bg], [h], i, cr, model, rtol=rtol)[0]
+
 
 # Inklinationswinkel berechnen
+@instrument.timed('angle')
 def angle(b, lg, bg, h):
 
     # Vektor zum Punkt P
@@ -97,9 +649,26 @@ def angle(b, lg, bg, h):
 
     # Winkel zum Normalvektor in Grad
     return phi / pi * 180
+
+# Inklinationswinkel für viele Punkte (B als (N, 3)-Array, Arrays der Koordinaten wie toCartBatch)
+@instrument.timed('angle')
+def angleBatch(bs, lgs, bgs, hs):
+
+    # Vektoren zu den Punkten P
+    rps = toCartBatch(lgs, bgs, hs)
+
+    # Winkel zwischen Normalvektor & Magnetfeld, in Grad
+    bs = asarray(bs, dtype=float).reshape(-1, 3)
+    phi = arccos((bs * rps).sum(axis=1) / norm(bs, axis=1) / norm(rps, axis=1))
+    return phi / pi * 180
     
 # Verarbeitung gemessener Daten
+@instrument.timed('processData')
 def processData(data):
+    # Kompakte Datensätze (geo.Records): Spalten direkt übernehmen
+    if (isinstance(data, geo.Records)):
+        return processColumns(data.columns())
+
     # Leere Listen worin Messdaten abgespeichert werden
     mes_lgs  = [] # Längengrade
     mes_bgs  = [] # Breitengrade
@@ -118,7 +687,59 @@ def processData(data):
     # Rückgabe
     return mes_lgs, mes_bgs, mes_alts, mes_mags, mes_vecs
 
+# Verarbeitung gemessener Daten im Spaltenformat (siehe geo.load_columns). Höhen & Felder
+# werden direkt (ohne Kopie) übernommen, nur die Winkel werden in Grad umgerechnet.
+@instrument.timed('processData')
+def processColumns(cols):
+    mes_lgs  = cols['long'] / pi * 180 # Längengrade
+    mes_bgs  = cols['lat'] / pi * 180  # Breitengrade
+    mes_alts = cols['alt']             # Höhen
+    mes_vecs = cols['B']               # B als Vektor, Shape (N, 3)
+    mes_mags = norm(mes_vecs, axis=1)  # Stärke der magn. Flussdichte
+
+    # Rückgabe
+    return mes_lgs, mes_bgs, mes_alts, mes_mags, mes_vecs
+
+# Messdaten laden & verarbeiten, mit Zwischenspeicher: processData(geo.load(fn)) wird nur
+# ausgeführt, wenn die Datei noch nicht geladen wurde oder sich seither verändert hat
+# (Änderungszeit oder Grösse). Es werden höchstens data_cache_size Datensätze behalten, der
+# am längsten nicht verwendete wird zuerst verworfen. Ist fn ein Verzeichnis, wird es als
+# Datensatz im Spaltenformat geladen (geo.load_columns & processColumns).
+def loadData(fn):
+    path = os.path.abspath(fn)
+    if (os.path.isdir(path)):
+        sts = [os.stat(os.path.join(path, name)) for name in sorted(os.listdir(path))]
+        key = (max(st.st_mtime_ns for st in sts), sum(st.st_size for st in sts))
+    else:
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+
+    # Treffer: Datei unverändert
+    entry = cacheGet(data_cache, path)
+    if (entry is not None and entry[0] == key):
+        instrument.count('data_cache.hit')
+        return entry[1]
+    instrument.count('data_cache.miss')
+
+    # Datei (neu) laden und verarbeiten
+    if (os.path.isdir(path)):
+        data = processColumns(geo.load_columns(path))
+    else:
+        data = processData(geo.load(path))
+    cachePut(data_cache, path, (key, data), data_cache_size)
+
+    return data
+
+# Zwischenspeicher leeren, für eine Datei fn oder (keine Angabe) für alle Dateien
+def invalidateData(fn=None):
+    with cache_lock:
+        if (fn is None):
+            data_cache.clear()
+        else:
+            data_cache.pop(os.path.abspath(fn), None)
+
 # Fehler zweier Vektoren berechnen
+@instrument.timed('error')
 def computeErrorVector(mes_bs, sim_bs):
     # Resultat
     res = 0.0
@@ -131,6 +752,7 @@ def computeErrorVector(mes_bs, sim_bs):
     return 1 / len(mes_bs) * sqrt(res)
 
 # Funktion um den Fehler des Winkels zu berechnen (Durchschnitt)
+@instrument.timed('error')
 def computeErrorNumeric(mes_ang, sim_ang):
     # Resultat
     res = 0.0
@@ -142,6 +764,155 @@ def computeErrorNumeric(mes_ang, sim_ang):
     # Faktor & Wurzel
     return 1 / len(mes_ang) * sqrt(res)
 
+# Relativer Fehler für Arrays von Zahlen; gleiches Resultat wie computeErrorNumeric
+@instrument.timed('error')
+def computeErrorNumericBatch(mes_ang, sim_ang):
+    mes_ang = asarray(mes_ang, dtype=float)
+    q = (mes_ang - asarray(sim_ang, dtype=float)) / mes_ang
+    return 1 / len(mes_ang) * sqrt(dot(q, q))
+
+# Messdaten laden (loadData) & alles vorberechnen, was sich zwischen den Kandidaten einer
+# Optimierung nicht ändert: Koordinaten als Arrays, Einheits-Normalvektoren an den Messpunkten,
+# gemessene Winkel (wie angle) & Beträge. Wird pro Datensatz einmal berechnet, solange
+# loadData die gleichen Daten liefert. Mit level wird nur eine Messung pro Zelle des flächen-
+# treuen Gitters dieser Stufe verwendet (siehe geo.cells & geo.subsamples).
+def prepareData(fn, level=None):
+    if (level is not None):
+        return subsampleData(fn, level)
+
+    data = loadData(fn)
+    path = os.path.abspath(fn)
+
+    # Treffer: gleiche (unveränderte) Daten
+    entry = cacheGet(prepared_cache, path)
+    if (entry is not None and entry[0] is data):
+        instrument.count('prepared_cache.hit')
+        return entry[1]
+    instrument.count('prepared_cache.miss')
+
+    prep = prepareArrays(*data)
+    cachePut(prepared_cache, path, (data, prep), data_cache_size)
+    return prep
+
+# Teilmenge der vorberechneten Daten (prepareData) mit einer Messung pro Zelle der Stufe level.
+# Jede Messung erhält als Gewicht (prep['weights'], siehe computeErrorSums) die Anzahl
+# Messungen ihrer Zelle, damit die Fehler jenen aller Messdaten möglichst nahe kommen.
+def subsampleData(fn, level):
+    prep = prepareData(fn)
+    key = (os.path.abspath(fn), int(level))
+
+    # Treffer: gleiche (unveränderte) Daten
+    entry = cacheGet(subsample_cache, key)
+    if (entry is not None and entry[0] is prep):
+        instrument.count('subsample_cache.hit')
+        return entry[1]
+    instrument.count('subsample_cache.miss')
+
+    lats, longs = prep['bgs'] / 180 * pi, prep['lgs'] / 180 * pi
+    idx = geo.subsamples(lats, longs, [level])[0]
+    sub = {name: values[idx] for name, values in prep.items()}
+    cells = geo.cells(lats, longs, level)
+    occupied, counts = unique(cells, return_counts=True)
+    sub['weights'] = counts[searchsorted(occupied, cells[idx])].astype(float)
+    cachePut(subsample_cache, key, (prep, sub), subsample_cache_size)
+    return sub
+
+# Vorberechnete Grössen (siehe prepareData) aus Arrays wie processData sie liefert
+def prepareArrays(mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs):
+    prep = {'lgs': asarray(mes_lgs, dtype=float),
+            'bgs': asarray(mes_bgs, dtype=float),
+            'alts': asarray(mes_alts, dtype=float),
+            'mags': asarray(mes_mags, dtype=float),
+            'bs': asarray(mes_bs, dtype=float).reshape(-1, 3)}
+    rps = toCartBatch(prep['lgs'], prep['bgs'], prep['alts'])
+    prep['normals'] = rps / norm(rps, axis=1)[:, newaxis]
+    prep['angs'] = angleBatch(prep['bs'], prep['lgs'], prep['bgs'], prep['alts'])
+    return prep
+
+# Teilsummen der Fehler eines Kandidaten in einem Durchgang: aus den simulierten Feldern
+# (N, 3) an den Messpunkten & den vorberechneten Messdaten (prepareData). Rückgabe:
+# (N, Summe der quadrierten relativen Fehler von Winkel, Betrag & Vektor). Teilsummen ver-
+# schiedener Blöcke von Messdaten werden mit mergeErrorSums zusammengefasst. Enthält prep
+# Gewichte (prep['weights'], siehe subsampleData), sind N & die Summen gewichtet.
+@instrument.timed('error')
+def computeErrorSums(sim_bs, prep):
+    # Beträge & Winkel zum Normalvektor der simulierten Felder
+    sim_mags = sqrt(einsum('ij,ij->i', sim_bs, sim_bs))
+    sim_angs = arccos(einsum('ij,ij->i', sim_bs, prep['normals']) / sim_mags) / pi * 180
+
+    # Relative Fehler
+    qa = (prep['angs'] - sim_angs) / prep['angs']
+    qm = (prep['mags'] - sim_mags) / prep['mags']
+    d = prep['bs'] - sim_bs
+    qv = einsum('ij,ij->i', d, d) / prep['mags']**2
+
+    # Gewichtete Summen (Teilmenge, siehe subsampleData)
+    w = prep.get('weights')
+    if (w is not None):
+        return w.sum(), dot(w * qa, qa), dot(w * qm, qm), dot(w, qv)
+    return len(sim_bs), dot(qa, qa), dot(qm, qm), qv.sum()
+
+# Zwei Teilsummen (siehe computeErrorSums) zusammenfassen
+def mergeErrorSums(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+# Fehler aus Teilsummen: Winkel- & Betragsfehler (wie computeErrorNumeric) & Vektorfehler
+# (wie computeErrorVector)
+def errorsFromSums(sums):
+    n = sums[0]
+    return 1 / n * sqrt(sums[1]), 1 / n * sqrt(sums[2]), 1 / n * sqrt(sums[3])
+
+# Winkel- & Betragsfehler eines Kandidaten in einem Durchgang (siehe computeErrorSums).
+# Gleiche Resultate wie computeErrorNumeric mit angle bzw. norm.
+def computeErrors(sim_bs, prep):
+    return errorsFromSums(computeErrorSums(sim_bs, prep))[:2]
+
+# Fehler eines Kandidaten (Strom i, Kreisradius cr) direkt ab einer Datei im MAGNET-Format,
+# ohne die Datenbank aufzubauen (siehe streamErrorsCandidates).
+# Rückgabe: Fehler (Winkel, Betrag, Vektor) & die Teilsummen
+def streamErrors(file, i, cr, year=2010, model=None, chunk=1 << 22):
+    return streamErrorsCandidates(file, [(i, cr)], year, model, chunk)[0]
+
+# Fehler vieler Kandidaten (Liste von (Strom, Kreisradius)) in einem Durchgang durch die Datei:
+# Die Datei wird blockweise gelesen (geo.stream), pro Block werden für jeden Kandidaten Feld &
+# Teilsummen berechnet und zusammengefasst. Das Feld ist linear im Strom, daher wird es pro
+# Block nur einmal pro Radius (für I = 1 A) berechnet. Der Speicherbedarf hängt nur von chunk
+# ab. Rückgabe: Liste mit (Fehler (Winkel, Betrag, Vektor), Teilsummen) pro Kandidat
+def streamErrorsCandidates(file, candidates, year=2010, model=None, chunk=1 << 22):
+    sums = [(0, 0.0, 0.0, 0.0)] * len(candidates)
+    crs = sorted(set(float(cr) for i, cr in candidates))
+
+    for cols in geo.stream(year, file, chunk):
+        # Block wie processColumns verarbeiten & Fehler-Teilsummen jedes Kandidaten addieren
+        prep = prepareArrays(*processColumns(cols))
+        unit_bs = {cr: bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], 1.0, cr, model)
+                   for cr in crs}
+        for k, (i, cr) in enumerate(candidates):
+            sums[k] = mergeErrorSums(sums[k], computeErrorSums(i * unit_bs[float(cr)], prep))
+
+    return [(errorsFromSums(s), s) for s in sums]
+
+# Optimaler Kreisradius (Winkelfehler, Strom i) direkt ab einer Datei im MAGNET-Format, wie
+# optimzeAngleLoop: pro Iteration werden steps Radien in einem Durchgang durch die Datei
+# ausgewertet (streamErrorsCandidates), danach wird der Bereich um den besten Radius ver-
+# kleinert. Rückgabe: Radius & Winkelfehler
+def optimzeAngleStream(file, start, end, steps, iterations, i=1e9, year=2010, model=None,
+                       chunk=1 << 22):
+    lower, upper = min(start, end), max(start, end)
+    cr, min_error = None, None
+
+    for n in range(iterations):
+        t = perf_counter()
+        crs = [lower + k * (upper - lower) / steps for k in range(steps + 1)]
+        errors = [res[0][0] for res in streamErrorsCandidates(file, [(i, c) for c in crs],
+                                                              year, model, chunk)]
+        k = errors.index(min(errors))
+        cr, min_error = crs[k], errors[k]
+        lower, upper = crs[max(k - 1, 0)], crs[min(k + 1, steps)]
+        instrument.iteration('optimzeAngleStream', n + 1, perf_counter() - t, cr=cr, error=min_error)
+
+    return cr, min_error
+
 '''
 ================================= OPTIMIERUNG DES WINKELS =================================
 Erste Idee:
@@ -156,7 +927,7 @@ etc.
 # Automatische Optimierung des Kreisradius, Winkel wird genauer
 def angleOptimization(resolution):
     # Gemessene Daten werden geladen
-    mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = processData(geo.load(pickle))
+    mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = loadData(pickle)
 
     # Anfangswerte
     i = 1e9
@@ -189,6 +960,9 @@ def angleOptimization(resolution):
         sim_angs = []
         mes_angs = []
 
+        # Simulierte Felder an allen Messpunkten auf einmal berechnen
+        sim_bs = bfieldBatch(mes_lgs, mes_bgs, mes_alts, i, cr)
+
         # Simulierte Werte für jedes Messdaten-Set
         for index in range(len(mes_lgs)):
             # Gemessene Werte
@@ -200,7 +974,7 @@ def angleOptimization(resolution):
             mes_ang = angle(mes_b, mes_lg, mes_bg, mes_alt) # Winkel zur Erdoberfläche
 
             # Simulierte Werte am gleichen Ort berechnen
-            sim_b   = bfield(mes_lg, mes_bg, mes_alt, i, cr)
+            sim_b   = sim_bs[index]
             sim_ang = angle(sim_b, mes_lg, mes_bg, mes_alt)
 
             # Berechnete Winkel für Fehlerrechnung ausserhalb Schleife abgespeichert
@@ -208,7 +982,7 @@ def angleOptimization(resolution):
             sim_angs.append(sim_ang)
 
         # Fehler brechnen
-        current_error = computeErrorNumeric(mes_angs, sim_angs)
+        current_error = computeErrorNumericBatch(mes_angs, sim_angs)
         print(str(current_error) + ' ' + str(cr))
 
         last_last_last_last_cr = last_last_last_cr
@@ -242,78 +1016,144 @@ Iterationen kann bestimmt werden.)
 ============================================================================================
 '''
 
-# Iterations-Schleife
-def optimzeAngleLoop(start, end, steps, iterations):
+# Kandidaten auswerten: func wird für jeden Kandidaten aufgerufen, mit n_workers > 1 parallel
+# in einem Prozess- oder Thread-Pool. Die Resultate kommen immer in der Reihenfolge der
+# Kandidaten zurück, daher sind sie identisch mit einer seriellen Auswertung.
+def mapCandidates(func, candidates, n_workers=None, kind=None):
+    n_workers = n_workers or workers
+    kind = kind or backend
+
+    # Seriell
+    if (n_workers <= 1 or len(candidates) <= 1):
+        return [func(c) for c in candidates]
+
+    # Pool wird beim ersten Gebrauch erstellt und danach wiederverwendet
+    pool = pools.get((kind, n_workers))
+    if (pool is None):
+        if (kind == 'process'):
+            pool = ProcessPoolExecutor(n_workers)
+        elif (kind == 'thread'):
+            pool = ThreadPoolExecutor(n_workers)
+        else:
+            raise ValueError('unbekanntes Backend: ' + str(kind))
+        pools[(kind, n_workers)] = pool
+
+    # Kandidaten gleichmässig auf die Worker verteilen
+    chunksize = max(1, len(candidates) // n_workers)
+    return list(pool.map(func, candidates, chunksize=chunksize))
+
+# Alle offenen Pools schliessen
+def shutdownPools():
+    for pool in pools.values():
+        pool.shutdown()
+    pools.clear()
+
+# Winkelfehler für einen Kreisradius cr (Strom i, Messdaten aus Datei fn, Feldmodell model,
+# Teilmenge der Stufe level, keine Angabe: alle Messdaten)
+def angleError(cr, i, fn, model=None, level=None):
+
+    # Messdaten mit vorberechneten Winkeln & Normalvektoren
+    prep = prepareData(fn, level)
+
+    # Simulierte Felder an allen Messpunkten auf einmal berechnen
+    sim_bs = bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], i, cr, model)
+
+    # Fehler brechnen
+    return computeErrors(sim_bs, prep)[0]
+
+# Beschreibung eines Fits für den Ergebnis-Speicher (resultcache): Datensatz, Feldmodell,
+# Auflösung & Code-Version, ergänzt um die Parameter params (ohne solche mit Wert None)
+def cacheParams(fn, model=None, **params):
+    params = {k: v for k, v in params.items() if v is not None}
+    params.update(data=resultcache.dataset_hash(fn), model=model or fieldmodel, n=100,
+                  code=resultcache.code_version())
+    return params
+
+# Iterations-Schleife. Mit levels (Liste von Stufen, siehe geo.cells) wird Iteration n nur mit
+# der Teilmenge der Stufe levels[n] gerechnet (grob bis fein, siehe prepareData); die weiteren
+# Iterationen mit allen Messdaten. Da das Optimum einer Teilmenge etwas neben jenem aller Daten
+# liegen kann, wird der Bereich nach einer solchen Iteration verdoppelt (widenRange) & in der
+# ersten Iteration mit allen Daten allenfalls wieder vergrössert (sweepInside). Mit levels
+# folgt immer mindestens eine Iteration mit allen Daten, auch wenn iterations <= len(levels).
+def optimzeAngleLoop(start, end, steps, iterations, n_workers=None, kind=None, levels=None):
+
+    # Gespeichertes Resultat eines gleichen Laufs
+    key = resultcache.key('optimzeAngleLoop', cacheParams(pickle, i=1e9, start=start, end=end,
+                                                          steps=steps, iterations=iterations,
+                                                          levels=levels))
+    res = resultcache.get(key)
+    if (res is not None):
+        return tuple(res)
 
     upper = start  # Start-Radius (Minimum)
     lower = end      # End-Radius (Maximum)
     cr, min_error = 0, 0 # Variablen für diese scope
 
     # Optimierungsschleife, work-in-progress
-    for n in range(iterations):
-        cr, min_error, upper, lower = optimzeAngle(upper, lower, steps)
+    for n in range(max(iterations, len(levels) + 1) if levels else iterations):
+        t = perf_counter()
+        level = levels[n] if (levels and n < len(levels)) else None
+        if (levels and n == len(levels)):
+            sweep = partial(optimzeAngle, steps=steps, n_workers=n_workers, kind=kind)
+            cr, min_error, upper, lower = sweepInside(sweep, upper, lower, start, end)
+        else:
+            cr, min_error, upper, lower = optimzeAngle(upper, lower, steps, n_workers, kind, level)
+        if (level is not None):
+            upper, lower = widenRange(cr, upper, lower, start, end)
+        instrument.iteration('optimzeAngleLoop', n + 1, perf_counter() - t, cr=cr, error=min_error)
         
     # Optimaler Radius mit kleinstem Fehler wird zurückgegeben
+    resultcache.put(key, (cr, min_error))
     return cr, min_error
         
-# Schleife für eine Iteration
-def optimzeAngle(start, end, steps):
+# Bereich [a, b] um x auf x +- factor * (grösserer Abstand von x zu a bzw. b) vergrössern,
+# höchstens bis zum Bereich [start, end]. Die Reihenfolge von a & b bleibt erhalten.
+def widenRange(x, a, b, start, end, factor=2):
+    lo, hi = min(start, end), max(start, end)
+    d = factor * max(abs(a - x), abs(b - x))
+    if (a <= b):
+        return max(lo, x - d), min(hi, x + d)
+    return min(hi, x + d), max(lo, x - d)
+
+# Eine Iteration sweep(a, b) (optimzeAngle bzw. optimizeMagnitude mit allen Messdaten). Liegt
+# das beste Resultat am Rand von [a, b] (der weitergegebene Nachbar ist es selbst), aber nicht
+# auf start bzw. end, kann das Optimum ausserhalb liegen: Der Bereich wird dann vergrössert
+# (widenRange, höchstens bis [start, end]) & neu abgetastet. Rückgabe wie sweep.
+def sweepInside(sweep, a, b, start, end):
+    lo, hi = min(start, end), max(start, end)
+    x, err, upper, lower = sweep(a, b)
+    while ((x == upper or x == lower) and x != lo and x != hi):
+        wider = widenRange(x, a, b, start, end)
+        if (wider == (a, b)):
+            break
+        a, b = wider
+        instrument.count('sweepInside.widen')
+        x, err, upper, lower = sweep(a, b)
+    return x, err, upper, lower
+
+# Schleife für eine Iteration (n_workers & kind: siehe mapCandidates, level: siehe angleError)
+def optimzeAngle(start, end, steps, n_workers=None, kind=None, level=None):
     
     i = 1e9
 
-    # Resultate (leere Listen)
-    errors = []
-    crs = []
+    # Radius eines jeden Schritts (min - max inkl. beider Enden, k Schritte), in Liste gespeichert
+    crs = [start + k * (end - start) / steps for k in range(steps + 1)]
 
-    # Daten ab Pickle-Datei
-    mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = processData(geo.load(pickle))
-    
-    # Jede unterteilung (min - max, k Schritte)
-    for k in range(steps):
-        # Radius eines jeden Schritts, in Liste gespeichert
-        cr = start + k * (end - start) / steps 
-        crs.append(cr)
+    # Fehler für jeden Radius, allenfalls parallel berechnet; bereits berechnete Fehler kommen
+    # aus dem Ergebnis-Speicher
+    errors = resultcache.candidates(
+        'angleError', cacheParams(pickle, i=i, level=level), crs,
+        lambda missing: mapCandidates(partial(angleError, i=i, fn=pickle, model=fieldmodel,
+                                              level=level),
+                                      missing, n_workers, kind))
 
-        # Leere Listen für simulierte Resultate
-        sim_angs = []
-        mes_angs = []
+    k            = errors.index(min(errors))        # Index des kleinsten Fehlers
+    min_error    = errors[k]                        # kleister Fehler
+    min_error_cr = crs[k]                           # dazu gehörender Radius
 
-        # Simulierte Werte für jedes Messdaten-Set
-        for index in range(len(mes_lgs)):
-            # Gemessene Werte
-            mes_lg  = mes_lgs[index]  # Längengrad in rad
-            mes_bg  = mes_bgs[index]  # Breitengrad in rad
-            mes_alt = mes_alts[index] # Höhe
-            mes_b   = mes_bs[index]   # Feld als Vektor
-            mes_mag = mes_mags[index] # Strärke von B
-            mes_ang = angle(mes_b, mes_lg, mes_bg, mes_alt) # Winkel zum Normalvektor
-
-            # Simulierte Werte am gleichen Ort berechnen
-            sim_b   = bfield(mes_lg, mes_bg, mes_alt, i, cr)
-            sim_ang = angle(sim_b, mes_lg, mes_bg, mes_alt)
-
-            # Berechnete Winkel für Fehlerrechnung ausserhalb Schleife abgespeichert
-            mes_angs.append(mes_ang)
-            sim_angs.append(sim_ang)
-
-        # Fehler brechnen
-        err = computeErrorNumeric(mes_angs, sim_angs)
-        errors.append(err)
-
-    min_error    = min(errors)                      # kleister Fehler wird herausgesucht
-    min_error_cr = crs[errors.index(min_error)]     # dazu gehörender Radius
-
-    # Bereich des kleinsten Fehlers wird weitergegeben
-    # Fallunterscheidung: ob die Bereiche möglich sind
-    if (len(crs) - 1 < errors.index(min_error) + 1):
-        upper_bound = crs[errors.index(min_error)]
-        lower_bound = crs[errors.index(min_error) - 1]
-    elif (errors.index(min_error) - 1 < 0):
-        upper_bound = crs[errors.index(min_error) + 1]
-        lower_bound = crs[errors.index(min_error)]
-    else:
-        upper_bound = crs[errors.index(min_error) + 1]
-        lower_bound = crs[errors.index(min_error) - 1]
+    # Bereich des kleinsten Fehlers (Nachbarn, am Rand auf die Enden begrenzt) wird weitergegeben
+    upper_bound = crs[min(k + 1, steps)]
+    lower_bound = crs[max(k - 1, 0)]
 
     # Resultate dieser Iteration
     return min_error_cr, min_error, upper_bound, lower_bound
@@ -325,82 +1165,474 @@ gibt es wieder um zwei Funktionen.
 ============================================================================================
 '''
 
-# Iterations-Schleife
-def optimizeMagnitudeLoop(start, end, steps, iterations):
+# Betragsfehler für einen Strom i (Kreisradius cr, Messdaten aus Datei fn, Feldmodell model)
+def magnitudeError(i, cr, fn, model=None, level=None):
+    # Messdaten mit vorberechneten Beträgen
+    prep = prepareData(fn, level)
 
-    upper_bound = end   # Erster Startwert (min)
-    lower_bound = start # Maximalwert für I
+    # Simulierte Felder an allen Messpunkten auf einmal berechnen
+    sim_bs = bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], i, cr, model)
+
+    # Fehler berechnen
+    return computeErrors(sim_bs, prep)[1]
+
+# Iterations-Schleife (levels & Rand der ersten Iteration mit allen Daten: siehe optimzeAngleLoop)
+def optimizeMagnitudeLoop(start, end, steps, iterations, n_workers=None, kind=None, levels=None):
+
+    # Gespeichertes Resultat eines gleichen Laufs
+    key = resultcache.key('optimizeMagnitudeLoop', cacheParams(pickle, cr=5e6, start=start, end=end,
+                                                               steps=steps, iterations=iterations,
+                                                               levels=levels))
+    res = resultcache.get(key)
+    if (res is not None):
+        return tuple(res)
+
+    upper_bound = start # Erster Startwert (min)
+    lower_bound = end   # Maximalwert für I
 
     # Variablen sollen in dieser scope ansprechbar sein
     min_error_i = None
     min_error = None
 
     # Iterationen
-    for j in range(iterations):
-        min_error_i, min_error, upper_bound, lower_bound = optimizeMagnitude(upper_bound, lower_bound, steps)
+    for j in range(max(iterations, len(levels) + 1) if levels else iterations):
+        t = perf_counter()
+        level = levels[j] if (levels and j < len(levels)) else None
+        if (levels and j == len(levels)):
+            sweep = partial(optimizeMagnitude, steps=steps, n_workers=n_workers, kind=kind)
+            min_error_i, min_error, upper_bound, lower_bound = sweepInside(sweep, upper_bound, lower_bound, start, end)
+        else:
+            min_error_i, min_error, upper_bound, lower_bound = optimizeMagnitude(upper_bound, lower_bound, steps, n_workers, kind, level)
+        if (level is not None):
+            upper_bound, lower_bound = widenRange(min_error_i, upper_bound, lower_bound, start, end)
+        instrument.iteration('optimizeMagnitudeLoop', j + 1, perf_counter() - t, i=min_error_i,
+                             error=min_error)
 
     # Resultate
+    resultcache.put(key, (min_error_i, min_error))
     return min_error_i, min_error 
         
-# Schleife einer Iteration
-def optimizeMagnitude(start, end, steps):
-    # Messdaten
-    mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = processData(geo.load(pickle))
+# Schleife einer Iteration (n_workers & kind: siehe mapCandidates, level: siehe angleError)
+def optimizeMagnitude(start, end, steps, n_workers=None, kind=None, level=None):
+    # Kreisradius
+    cr = 5e6
 
-    # Arrays für Resultate
-    i_s = []
-    errors = []
+    # I für jeden Abschnitt k (inkl. beider Enden) wird ermittelt und abgespeichert
+    i_s = [start + k * (end - start) / steps for k in range(steps + 1)]
+
+    # Fehler für jeden Strom, allenfalls parallel berechnet; bereits berechnete Fehler kommen
+    # aus dem Ergebnis-Speicher
+    errors = resultcache.candidates(
+        'magnitudeError', cacheParams(pickle, cr=cr, level=level), i_s,
+        lambda missing: mapCandidates(partial(magnitudeError, cr=cr, fn=pickle, model=fieldmodel,
+                                              level=level),
+                                      missing, n_workers, kind))
+
+    k = errors.index(min(errors))  # Index des kleinsten Fehlers
+    min_error = errors[k]          # kleister Fehler
+    min_error_i = i_s[k]           # dazu gehörender Strom
+
+    # Range für die nächste Iteration (Bereich worin sich der optimale Strom befinden soll),
+    # Nachbarn des besten Stroms, am Rand auf die Enden begrenzt
+    upper_bound = i_s[min(k + 1, steps)]
+    lower_bound = i_s[max(k - 1, 0)]
+    
+    # Resultate werden zurückgegeben
+    return min_error_i, min_error, upper_bound, lower_bound
 
-    # Kreisradius
+'''
+============================================================================================
+Dritte Idee:
+Statt in jeder Iteration wieder steps Werte gleichmässig abzutasten, wird das Intervall mit 
+dem Verfahren von Brent (Goldener Schnitt kombiniert mit parabolischer Interpolation) ver-
+kleinert. Pro Schritt wird der Fehler nur einmal ausgewertet und das Minimum ist meist nach
+wenigen Dutzend Auswertungen auf tol genau bestimmt. Funktioniert für Radius & Strom.
+============================================================================================
+'''
+
+# Minimum von f im Intervall [a, b] nach Brent. tol ist die gewünschte Genauigkeit relativ
+# zur Intervallbreite, maxeval die maximale Anzahl Auswertungen von f.
+# Rückgabe: x, f(x) & Anzahl Auswertungen
+def minimizeBrent(f, a, b, tol=1e-6, maxeval=100):
+    a, b = min(a, b), max(a, b)
+    xtol = tol * (b - a)
+    c = (3 - sqrt(5)) / 2  # Goldener Schnitt
+
+    # x: bester Punkt, w: zweitbester, v: vorheriger Wert von w
+    x = w = v = a + c * (b - a)
+    fx = fw = fv = f(x)
+    evals = 1
+    d = e = 0.0  # letzter & vorletzter Schritt
+
+    while (evals < maxeval):
+        t = perf_counter()
+        xm = (a + b) / 2
+        tol1 = 1.5e-8 * abs(x) + xtol / 3
+        tol2 = 2 * tol1
+
+        # Abbruch, sobald das Intervall klein genug ist
+        if (abs(x - xm) <= tol2 - (b - a) / 2):
+            break
+
+        # Parabel durch x, w & v versuchen
+        golden = True
+        if (abs(e) > tol1):
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2 * (q - r)
+            if (q > 0):
+                p = -p
+            q = abs(q)
+            r, e = e, d
+
+            # Parabelschritt nur, wenn er im Intervall liegt & klein genug ist
+            if (abs(p) < abs(q * r / 2) and q * (a - x) < p < q * (b - x)):
+                d = p / q
+                u = x + d
+                if (u - a < tol2 or b - u < tol2):
+                    d = tol1 if x < xm else -tol1
+                golden = False
+
+        # Sonst Schritt nach dem Goldenen Schnitt in den grösseren Teil
+        if (golden):
+            e = (b - x) if x < xm else (a - x)
+            d = c * e
+
+        # Neuer Punkt, mindestens tol1 von x entfernt
+        if (abs(d) >= tol1):
+            u = x + d
+        else:
+            u = x + (tol1 if d > 0 else -tol1)
+        fu = f(u)
+        evals += 1
+        instrument.iteration('minimizeBrent', evals, perf_counter() - t, x=u, error=fu)
+
+        # Intervall & Punkte nachführen
+        if (fu <= fx):
+            if (u < x):
+                b = x
+            else:
+                a = x
+            v, fv, w, fw, x, fx = w, fw, x, fx, u, fu
+        else:
+            if (u < x):
+                a = u
+            else:
+                b = u
+            if (fu <= fw or w == x):
+                v, fv, w, fw = w, fw, u, fu
+            elif (fu <= fv or v == x or v == w):
+                v, fv = u, fu
+
+    return x, fx, evals
+
+# Optimaler Kreisradius in [start, end] nach Brent (Strom fest wie in optimzeAngle)
+# Rückgabe: Radius, Fehler & Anzahl Auswertungen
+def optimzeAngleBrent(start, end, tol=1e-6, maxeval=100):
+    i = 1e9
+    return minimizeBrent(partial(angleError, i=i, fn=pickle, model=fieldmodel),
+                         start, end, tol, maxeval)
+
+# Optimaler Strom in [start, end] nach Brent (Radius fest wie in optimizeMagnitude)
+# Rückgabe: Strom, Fehler & Anzahl Auswertungen
+def optimizeMagnitudeBrent(start, end, tol=1e-6, maxeval=100):
     cr = 5e6
+    return minimizeBrent(partial(magnitudeError, cr=cr, fn=pickle, model=fieldmodel),
+                         start, end, tol, maxeval)
 
-    # Berechnung von I und dessen Fehler für den Abschnitt k
-    for k in range(steps):
+'''
+============================================================================================
+Geschlossene Lösung:
+Das Feld ist linear im Strom I, d.h. |B(I)| = I * |B(1)|. Es genügt also, das Feld für I = 1 A
+einmal pro Kreisradius zu berechnen. Der Fehler (computeErrorNumeric) ist dann eine quadra-
+tische Funktion von I, deren Minimum direkt berechnet werden kann:
+    Summe((m_k - I * u_k) / m_k)^2 -> min   =>   I = Summe(q_k) / Summe(q_k^2),  q_k = u_k / m_k
+============================================================================================
+'''
 
-        # I wird ermittelt und abgespeichert
-        i = start + k * (end - start) / steps
-        i_s.append(i)
+# Optimaler Strom für einen Kreisradius ohne Suche, gleiche Rückgabe wie optimizeMagnitudeLoop
+def optimizeMagnitudeLinear(cr=5e6):
+    # Messdaten als Arrays
+    prep = prepareData(pickle)
 
-        # Werte werden abgespeichert um Fehler ermitteln zu können
-        m_mags = []
-        s_mags = []
+    # Feldstärken für I = 1 A an allen Messpunkten (ein einziger Durchgang)
+    unit_mags = norm(bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], 1.0, cr), axis=1)
 
-        # Simulierte Werte für jedes Messdaten-Set
-        for index in range(len(mes_lgs)):
-            
-            # Gemessene Werte
-            mes_lg  = mes_lgs[index]  # Längengrad in rad
-            mes_bg  = mes_bgs[index]  # Breitengrad in rad
-            mes_alt = mes_alts[index] # Höhe
-            mes_mag = mes_mags[index] # Strärke von B
+    # Verhältnis simuliert (1 A) zu gemessen
+    q = unit_mags / prep['mags']
 
-            # Simulierte Werte am gleichen Ort berechnen
-            sim_mag = norm(bfield(mes_lg, mes_bg, mes_alt, i, cr))
+    # Minimum der quadratischen Fehlerfunktion
+    min_error_i = q.sum() / (q**2).sum()
+    min_error = computeErrorNumericBatch(prep['mags'], min_error_i * unit_mags)
 
-            # Berechnete Winkel für Fehlerrechnung ausserhalb Schleife abgespeichert
-            m_mags.append(mes_mag)
-            s_mags.append(sim_mag)
-
-        # Fehler berechnen und speichern
-        err = computeErrorNumeric(m_mags, s_mags)
-        errors.append(err)
-
-    min_error = min(errors)                    # kleister Fehler wird herausgesucht
-    min_error_i = i_s[errors.index(min_error)] # dazu gehörender Strom
-
-    # Range für die nächste Iteration (Bereich worin sich der optimale Strom befinden soll)
-    if (len(i_s) - 1 < errors.index(min_error) + 1):
-        upper_bound = i_s[errors.index(min_error)]
-        lower_bound = i_s[errors.index(min_error) - 1]
-    elif (errors.index(min_error) - 1 < 0):
-        upper_bound = i_s[errors.index(min_error) + 1]
-        lower_bound = i_s[errors.index(min_error)]
-    else:
-        upper_bound = i_s[errors.index(min_error) + 1]
-        lower_bound = i_s[errors.index(min_error) - 1]
-    
     # Resultate werden zurückgegeben
-    return min_error_i, min_error, upper_bound, lower_bound
+    return min_error_i, min_error
+
+'''
+================================ GEMEINSAME OPTIMIERUNG ===================================
+Radius & Strom werden nicht nacheinander, sondern gleichzeitig optimiert. Minimiert wird der 
+Vektorfehler aus computeErrorVector, d.h. die Residuen r_k = (B_sim,k - B_mes,k) / |B_mes,k| 
+aller Messpunkte. Das Verfahren ist Levenberg-Marquardt: Gauss-Newton-Schritte mit der 
+Jacobi-Matrix (dB/dI = B/I ist exakt, dB/dcr aus bfieldGradBatch), gedämpft mit lam, wenn 
+ein Schritt den Fehler nicht verkleinert.
+============================================================================================
+'''
+
+# Gemeinsame Optimierung von Kreisradius & Strom ausgehend von cr (& i, keine Angabe: beste
+# Stromstärke für cr). Abbruch, wenn sich die Parameter relativ um weniger als tol ändern.
+# Der Radius wird in [cr_min, cr_max] gehalten (Schritte werden auf diesen Bereich projiziert),
+# damit die Schleife im Erdinneren bleibt.
+# Rückgabe: cr, i, Fehler, Verlauf (Liste mit (Iteration, cr, i, Fehler, Zeit [s])) & Grund
+# des Abbruchs: 'converged' (konvergiert), 'bound' (konvergiert, Radius aber an einer Grenze),
+# 'stalled' (kein Schritt verkleinert den Fehler mehr) oder 'iterations' (nicht konvergiert)
+def optimizeJoint(cr=5e6, i=None, tol=1e-10, iterations=50, model=None, verbose=False,
+                  cr_min=1e3, cr_max=0.99 * re):
+    # Messdaten als Arrays
+    mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = loadData(pickle)
+    mes_bs = asarray(mes_bs, dtype=float).reshape(-1, 3)
+    w = 1 / asarray(mes_mags, dtype=float)[:, newaxis]  # Gewichte 1 / |B_mes|
+    N = len(mes_bs)
+
+    # Feld für I = 1 A & dessen Ableitung nach cr
+    cr = min(max(cr, cr_min), cr_max)
+    u, du = bfieldGradBatch(mes_lgs, mes_bgs, mes_alts, 1.0, cr, model)
+
+    # Startwert für I: Minimum des (in I quadratischen) Fehlers bei festem cr
+    if (i is None):
+        i = ((u * mes_bs) * w**2).sum() / ((u * w)**2).sum()
+
+    r = ((i * u - mes_bs) * w).ravel()
+    cost = dot(r, r)
+    lam = 1e-3
+    history = []
+    reason = 'iterations'
+
+    for j in range(iterations):
+        t = perf_counter()
+
+        # Jacobi-Matrix (3N x 2) nach cr & I, Normalgleichungen
+        J = empty((3 * N, 2))
+        J[:, 0] = (i * du * w).ravel()
+        J[:, 1] = (u * w).ravel()
+        A = dot(J.T, J)
+        g = dot(J.T, r)
+
+        # Gedämpfte Schritte, bis der Fehler kleiner wird. Für Versuche genügt das Feld, die
+        # Ableitung wird erst für den angenommenen Schritt berechnet.
+        while True:
+            try:
+                delta = solve(A + lam * diag(diag(A)), -g)
+            except LinAlgError:
+                delta = None
+            if (delta is not None):
+                # Radius auf [cr_min, cr_max] projizieren; liegt er an der Grenze, wird nur
+                # der Strom (bei festem Radius) optimiert
+                cr_new = min(max(cr + delta[0], cr_min), cr_max)
+                if (cr_new != cr + delta[0]):
+                    delta = array([cr_new - cr, -g[1] / (A[1, 1] * (1 + lam))])
+                i_new = i + delta[1]
+                u_new = bfieldBatch(mes_lgs, mes_bgs, mes_alts, 1.0, cr_new, model)
+                r_new = ((i_new * u_new - mes_bs) * w).ravel()
+                cost_new = dot(r_new, r_new)
+                if (cost_new <= cost):
+                    break
+            lam *= 10
+            if (lam > 1e16):
+                delta = None
+                break
+
+        # Kein Fortschritt mehr möglich
+        if (delta is None):
+            reason = 'stalled'
+            break
+
+        if (cr_new != cr):
+            u_new, du = bfieldGradBatch(mes_lgs, mes_bgs, mes_alts, 1.0, cr_new, model)
+        cr, i, u, r, cost = cr_new, i_new, u_new, r_new, cost_new
+        lam = max(lam / 10, 1e-12)
+
+        # Verlauf: Iteration, Parameter, Fehler (wie computeErrorVector) & Zeit
+        history.append((j + 1, cr, i, sqrt(cost) / N, perf_counter() - t))
+        instrument.iteration('optimizeJoint', j + 1, history[-1][4], cr=cr, i=i, error=history[-1][3])
+        if (verbose):
+            print(str(j + 1) + '\t' + str(cr) + '\t' + str(i) + '\t' + str(sqrt(cost) / N)
+                  + '\t' + str(round(history[-1][4], 3)) + ' s')
+
+        # Abbruch bei kleiner relativer Änderung
+        if (abs(delta[0]) <= tol * abs(cr) and abs(delta[1]) <= tol * abs(i)):
+            reason = 'bound' if (cr <= cr_min or cr >= cr_max) else 'converged'
+            break
+
+    return cr, i, sqrt(cost) / N, history, reason
+
+'''
+================================= ZEITREIHE (EPOCHEN) =====================================
+Die Messungen stammen aus verschiedenen Jahren (Datum in Item B). Um die säkulare Variation
+zu verfolgen, werden Kreisradius & Strom für eine Folge von Epochen bestimmt; eine Epoche
+umfasst die Messungen im Zeitfenster Mitte +- window / 2 (gleitende Fenster, wenn window
+grösser als der Abstand der Epochen ist). Die Daten werden einmal nach Datum sortiert, eine
+Epoche ist dann ein zusammenhängender Ausschnitt davon. Der Radius jeder Epoche wird mit
+Brent gesucht, ausgehend vom Optimum der vorherigen Epoche in einem verkleinerten Intervall;
+der Strom folgt in geschlossener Form (wie optimizeMagnitudeLinear).
+============================================================================================
+'''
+
+# Messdaten aus fn (wie loadData) mit vorberechneten Grössen (wie prepareData), nach Datum
+# sortiert. Rückgabe: vorberechnete Daten & sortierte Daten (Jahre)
+def epochData(fn):
+    path = os.path.abspath(fn)
+    if (os.path.isdir(path)):
+        db = geo.load_columns(path)
+        data = processColumns(db)
+    else:
+        db = geo.load(path)
+        data = processData(db)
+    dates = geo.dates(db)
+
+    order = argsort(dates, kind='stable')
+    prep = prepareArrays(*[asarray(x, dtype=float)[order] for x in data])
+    return prep, dates[order]
+
+# Grenzen (a, b) der Ausschnitte nach Datum sortierter Daten (dates) für die Epochen
+def epochSlices(dates, epochs, window):
+    epochs = asarray(epochs, dtype=float)
+    lo = searchsorted(dates, epochs - window / 2)
+    hi = searchsorted(dates, epochs + window / 2)
+    return [(int(a), int(b)) for a, b in zip(lo, hi)]
+
+# Radius in [start, end] (Brent, Winkelfehler; der Winkel hängt nicht vom Strom ab) & Strom
+# (geschlossen) für vorberechnete Daten prep. Rückgabe: cr, i, Winkel- & Betragsfehler,
+# Anzahl Auswertungen
+def fitEpoch(prep, start, end, tol=1e-6, maxeval=100, model=None):
+    def error(cr):
+        sim_bs = bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], 1.0, cr, model)
+        return computeErrors(sim_bs, prep)[0]
+
+    cr, angle_err, evals = minimizeBrent(error, start, end, tol, maxeval)
+
+    # Strom wie in optimizeMagnitudeLinear
+    unit_bs = bfieldBatch(prep['lgs'], prep['bgs'], prep['alts'], 1.0, cr, model)
+    q = norm(unit_bs, axis=1) / prep['mags']
+    i = q.sum() / (q**2).sum()
+    mag_err = computeErrors(i * unit_bs, prep)[1]
+    return cr, i, angle_err, mag_err, evals
+
+# Kreisradius & Strom für jede Epoche (Liste von Jahren, Fenster window Jahre) aus den Mess-
+# daten in fn; Radius in [start, end], Genauigkeit tol relativ zu end - start. Ab der zweiten
+# Epoche wird nur cr_vorher * (1 +- narrow) durchsucht; liegt das Optimum am Rand dieses
+# Intervalls (näher als edge * Intervallbreite), wird die Epoche im ganzen Intervall wieder-
+# holt. Epochen mit weniger als min_records Messungen werden übersprungen.
+# Rückgabe: Liste mit (Epoche, Anzahl Messungen, cr, i, Winkelfehler, Betragsfehler,
+# Anzahl Auswertungen, am Rand), wobei am Rand True ist, wenn der Radius am Rand von
+# [start, end] liegt (das Optimum liegt dann vermutlich ausserhalb)
+def optimizeEpochs(fn, epochs, window=1.0, start=1e6, end=6e6, narrow=0.1, tol=1e-6,
+                   min_records=3, model=None, verbose=False, edge=0.01):
+    # Daten einmal laden & sortieren
+    prep, dates = epochData(fn)
+    xtol = tol * (end - start)  # absolute Genauigkeit des Radius
+
+    results = []
+    cr = None
+    for epoch, (a, b) in zip(epochs, epochSlices(dates, epochs, window)):
+        if (b - a < min_records):
+            continue
+        t = perf_counter()
+        part = {name: values[a:b] for name, values in prep.items()}
+
+        # Warmstart: verkleinertes Intervall um das vorherige Optimum
+        lo, hi = start, end
+        if (cr is not None):
+            lo, hi = max(start, cr * (1 - narrow)), min(end, cr * (1 + narrow))
+        res = fitEpoch(part, lo, hi, xtol / (hi - lo), model=model)
+
+        # Optimum am Rand des verkleinerten Intervalls: ganzes Intervall durchsuchen. Brent
+        # nähert sich dem Rand nur bis auf einige tol, daher ein Anteil der Intervallbreite.
+        margin = max(edge * (hi - lo), 4 * xtol)
+        if ((lo > start and res[0] - lo < margin) or (hi < end and hi - res[0] < margin)):
+            evals = res[4]
+            res = fitEpoch(part, start, end, tol, model=model)
+            res = res[:4] + (res[4] + evals,)
+
+        # Optimum am Rand des ganzen Intervalls
+        margin = max(edge * (end - start), 4 * xtol)
+        at_bound = bool(res[0] - start < margin or end - res[0] < margin)
+
+        cr = res[0]
+        results.append((epoch, b - a) + res + (at_bound,))
+        instrument.iteration('optimizeEpochs', len(results), perf_counter() - t, epoch=epoch,
+                             cr=res[0], i=res[1], error=res[2])
+        if (verbose):
+            print(str(epoch) + '\t' + str(b - a) + '\t' + str(res[0]) + '\t' + str(res[1])
+                  + '\t' + str(res[2]) + '\t' + str(res[4]) + ('\tam Rand' if at_bound else ''))
+
+    return results
+
+'''
+======================================== FELDKARTE ========================================
+Das Feld wird auf einem regelmässigen Gitter (Höhen x Breitengrade x Längengrade) berechnet.
+Die Gitterpunkte werden in Blöcken zu chunk Punkten ausgewertet und direkt in eine .npy-Datei
+geschrieben (memory-mapped), daher bleibt der Speicherbedarf unabhängig von der Grösse des
+Gitters. Nach jedem Block wird der Fortschritt in fn + '.progress' gespeichert, zusammen mit einem
+Fingerabdruck von Gitter, Strom, Radius, Modell & Code; ein abgebrochener Lauf wird beim
+nächsten Aufruf mit den gleichen Argumenten dort fortgesetzt, sonst wird neu begonnen.
+============================================================================================
+'''
+
+# Grössen pro Gitterpunkt in der Feldkarte
+map_fields = ['Bx', 'By', 'Bz', '|B|', 'angle']
+
+# Feldkarte berechnen (Arrays der Längengrade [°], Breitengrade [°] & Höhen [m]). Resultat ist
+# ein Array (Höhe, Breitengrad, Längengrad, map_fields) in der Datei fn.
+def fieldMap(fn, lgs, bgs, hs, i=1e9, cr=5e6, model=None, chunk=100000, verbose=False):
+    lgs = atleast_1d(asarray(lgs, dtype=float))
+    bgs = atleast_1d(asarray(bgs, dtype=float))
+    hs = atleast_1d(asarray(hs, dtype=float))
+    shape = (len(hs), len(bgs), len(lgs), len(map_fields))
+    total = int(prod(shape[:3]))
+    progress_fn = fn + '.progress'
+    # Fingerabdruck von Gitter & Parametern: Nur ein Fortschritt zur gleichen Karte wird fortgesetzt
+    fingerprint = resultcache.key('fieldMap', lgs, bgs, hs, i, cr, model or fieldmodel, 100,
+                                  resultcache.code_version())
+
+    # Fortsetzen, falls ein Fortschritt zur gleichen Karte existiert
+    done = 0
+    if (os.path.exists(progress_fn) and os.path.exists(fn)):
+        with open(progress_fn) as f:
+            progress = f.read().split()
+        if (len(progress) == 2 and progress[0] == fingerprint):
+            out = open_memmap(fn, mode='r+')
+            done = int(progress[1])
+            if (out.shape != shape):
+                del out
+                done = 0
+    if (done == 0):
+        out = open_memmap(fn, mode='w+', dtype='float64', shape=shape)
+
+    # Gitterpunkte blockweise auswerten
+    for s in range(done, total, chunk):
+        e = min(s + chunk, total)
+        ih, ib, il = unravel_index(arange(s, e), shape[:3])
+        block_lgs, block_bgs, block_hs = lgs[il], bgs[ib], hs[ih]
+
+        bs = bfieldBatch(block_lgs, block_bgs, block_hs, i, cr, model)
+        block = out.reshape(total, len(map_fields))[s:e]
+        block[:, 0:3] = bs
+        block[:, 3] = norm(bs, axis=1)
+        block[:, 4] = angleBatch(bs, block_lgs, block_bgs, block_hs)
+
+        # Erst die Daten, dann den Fortschritt sichern
+        out.flush()
+        with open(progress_fn + '.tmp', 'w') as f:
+            f.write(fingerprint + ' ' + str(e))
+        os.replace(progress_fn + '.tmp', progress_fn)
+        if (verbose):
+            print(str(e) + ' / ' + str(total))
+
+    # Fertig: Fortschritts-Datei wird nicht mehr gebraucht
+    if (os.path.exists(progress_fn)):
+        os.remove(progress_fn)
+    return out
 
 # Hauptfunktion
 def main():
@@ -409,7 +1641,11 @@ def main():
     #  B) Alle Messerte anzeigen
     #  C) Winkeloptimierung durchführen
     #  D) |B| optimieren
-    options_text = '  A) Rechnen \n  B) Messwerte anzeigen \n  C) Winkeloptimierung \n  D) |B| optimieren'
+    #  E) |B| optimieren, geschlossene Lösung
+    #  F) Kreisradius & Strom gemeinsam optimieren
+    #  G) Feldkarte berechnen
+    #  H) Radius & Strom pro Epoche (Zeitreihe)
+    options_text = '  A) Rechnen \n  B) Messwerte anzeigen \n  C) Winkeloptimierung \n  D) |B| optimieren \n  E) |B| optimieren (geschlossen) \n  F) Radius & Strom gemeinsam \n  G) Feldkarte \n  H) Zeitreihe'
     print('Was soll gemacht werden? [A, B, C]')
     print(options_text)
 
@@ -417,7 +1653,7 @@ def main():
     m = True
     while m:
         a = input(':').upper()
-        if (a == 'A' or a == 'B' or a == 'C' or a == 'D'):
+        if (a == 'A' or a == 'B' or a == 'C' or a == 'D' or a == 'E' or a == 'F' or a == 'G' or a == 'H'):
             m = False
 
     # B ab einzugebenen Werten simulieren
@@ -437,7 +1673,7 @@ def main():
     # Alle Messdaten anzeigen
     elif (a == 'B'):
         # Daten laden
-        mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = processData(geo.load(pickle))
+        mes_lgs, mes_bgs, mes_alts, mes_mags, mes_bs = loadData(pickle)
         # Alle Daten anzeigen
         print('lg \tbg \th \tmag \t\tang \tB')
         for k in range(len(mes_lgs)):
@@ -452,31 +1688,91 @@ def main():
 
     # Winkeloptimierung mittels Kreisradiusänderung
     elif (a == 'C'):
-        # Eingabe: Schrittgrösse, Iterationen, Start-/Endwert, Kreisradius
-        steps      = int(input("Anz. Schritte: \t"))
-        iterations = int(input("Interationen: \t"))
-        start      = int(input("Anfangswert: \t"))
-        end        = int(input("Endwert: \t"))
+        # Eingabe: Verfahren (R: Raster, B: Brent), Start-/Endwert, Schrittgrösse & Iterationen
+        method     = (input("Verfahren (R/B): \t") or 'R').upper()
+        start      = float(input("Anfangswert: \t"))
+        end        = float(input("Endwert: \t"))
 
         # optimaler Radius & Fehler ermitteln
-        cr, err = optimzeAngleLoop(start, end, steps, iterations)
+        if (method == 'B'):
+            cr, err, evals = optimzeAngleBrent(start, end)
+        else:
+            steps      = int(input("Anz. Schritte: \t"))
+            iterations = int(input("Interationen: \t"))
+            cr, err = optimzeAngleLoop(start, end, steps, iterations)
         
         # Werte anzeigen
         print('optimaler Kreisradius: \t' + str(cr) + '\nmit Fehler: \t' + str(err))
 
+    # Optimierung |B| durch Stromstärke, geschlossene Lösung
+    elif (a == 'E'):
+        # Eingabe: Kreisradius
+        cr = float(input("Kreisradius: ") or 5e6)
+
+        # optimaler Strom mit Fehler ermitteln
+        i, err = optimizeMagnitudeLinear(cr)
+
+        # Werte Anzeigen
+        print('optimaler Strom: \t' + str(i) + '\nmit Fehler: \t' + str(err))
+
+    # Gemeinsame Optimierung von Kreisradius & Stromstärke
+    elif (a == 'F'):
+        # Eingabe: Anfangswert Kreisradius
+        cr = float(input("Kreisradius: ") or 5e6)
+
+        # Optimierung, Verlauf wird angezeigt
+        print('It. \tKreisradius \tStrom \tFehler \tZeit')
+        cr, i, err, history, reason = optimizeJoint(cr, verbose=True)
+
+        # Werte Anzeigen
+        print('optimaler Kreisradius: \t' + str(cr) + '\noptimaler Strom: \t' + str(i)
+              + '\nmit Fehler: \t' + str(err) + '\nAbbruch: \t' + reason)
+
+    # Feldkarte auf einem regelmässigen Gitter
+    elif (a == 'G'):
+        # Eingabe: Auflösung, Höhen, Strom, Kreisradius, Datei
+        res = float(input('Auflösung [°]: \t') or 1)
+        hs  = [float(h) for h in (input('Höhen [m]: \t') or '0').split()]
+        i   = float(input('Strom: \t\t') or 1e9)
+        cr  = float(input('Kreisradius: \t') or 5e6)
+        fn  = input('Datei: \t\t') or 'feldkarte.npy'
+
+        # Gitter: Längengrade -180 bis 180, Breitengrade -90 bis 90
+        lgs = arange(-180, 180, res)
+        bgs = arange(-90, 90 + res / 2, res)
+        out = fieldMap(fn, lgs, bgs, hs, i, cr, verbose=True)
+        print('Feldkarte ' + str(out.shape) + ' gespeichert in ' + fn)
+
+    # Radius & Strom pro Epoche
+    elif (a == 'H'):
+        # Eingabe: erste & letzte Epoche, Abstand & Fenster in Jahren
+        first  = float(input('Erste Epoche: \t') or 1990)
+        last   = float(input('Letzte Epoche: \t') or 2016)
+        step   = float(input('Abstand: \t') or 1)
+        window = float(input('Fenster: \t') or 1)
+
+        # Fit aller Epochen, Verlauf wird angezeigt
+        print('Epoche \tAnzahl \tKreisradius \tStrom \tWinkelfehler \tAuswertungen')
+        optimizeEpochs(pickle, arange(first, last + step / 2, step), window, verbose=True)
+
     # Optimierung |B| durch Stromstärke
     else:
-        # Eingabe: Schrittgrösse, Iterationen, Start-/Endwert
-        steps      = int(input("Anz. Schritte: "))
-        iterations = int(input("Interationen: "))
-        start      = int(input("Anfangswert: "))
-        end        = int(input("Endwert: "))
+        # Eingabe: Verfahren (R: Raster, B: Brent), Start-/Endwert, Schrittgrösse & Iterationen
+        method     = (input("Verfahren (R/B): ") or 'R').upper()
+        start      = float(input("Anfangswert: "))
+        end        = float(input("Endwert: "))
 
         # optimaler Strom mit Fehler ermitteln
-        i, err = optimizeMagnitudeLoop(start, end, steps, iterations)
+        if (method == 'B'):
+            i, err, evals = optimizeMagnitudeBrent(start, end)
+        else:
+            steps      = int(input("Anz. Schritte: "))
+            iterations = int(input("Interationen: "))
+            i, err = optimizeMagnitudeLoop(start, end, steps, iterations)
     
         # Werte Anzeigen
         print('optimaler Strom: \t' + str(i) + '\nmit Fehler: \t' + str(err))
 
 # Programmstart
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()